@@ -1,6 +1,14 @@
 # -*- coding: utf-8 -*-
 from django import forms
-from django.contrib import admin
+from django.conf.urls import patterns, url
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.core.servers.basehttp import FileWrapper
+from django.core.urlresolvers import reverse
+from django.http import Http404, HttpResponseRedirect, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.template import Template, TemplateSyntaxError
+from django.utils.functional import lazy
 from django.utils.translation import ugettext_lazy as _
 
 from opps.contrib.multisite.admin import AdminViewPermission
@@ -9,10 +17,16 @@ from opps.core.admin import apply_opps_rules
 from opps.core.widgets import OppsEditor
 from opps.images.generate import image_url
 
-from .models import Promo, Answer, PromoContainer
+from .export import (export_response, supported_formats, ExportTooLarge,
+                     EXPORT_XLSX_MAX_ROWS)
+from .mail import queue_winner_notifications
+from .models import Promo, Answer, PromoContainer, Outbox, ExportJob
+from .ratelimit import parse_limits
+from .tasks import schedule_outbox_delivery, start_export_job
 
 from import_export import resources
 from import_export.admin import ImportExportModelAdmin
+from import_export.forms import ExportForm
 
 
 class PromoAdminForm(forms.ModelForm):
@@ -26,6 +40,28 @@ class PromoAdminForm(forms.ModelForm):
             "result": OppsEditor()
         }
 
+    def clean_template(self, field):
+        source = self.cleaned_data.get(field)
+        try:
+            Template(source or u'')
+        except TemplateSyntaxError as e:
+            raise forms.ValidationError(unicode(e))
+        return source
+
+    def clean_rate_limits(self):
+        value = self.cleaned_data.get('rate_limits') or u''
+        try:
+            parse_limits(value)
+        except ValueError as e:
+            raise forms.ValidationError(unicode(e))
+        return value
+
+    def clean_confirmation_email_txt(self):
+        return self.clean_template('confirmation_email_txt')
+
+    def clean_confirmation_email_html(self):
+        return self.clean_template('confirmation_email_html')
+
 
 @apply_opps_rules('promos')
 class PromoContainerInline(admin.TabularInline):
@@ -44,8 +80,9 @@ class PromoAdmin(PublishableAdmin, AdminViewPermission):
     form = PromoAdminForm
     prepopulated_fields = {"slug": ["title"]}
     list_display = ['title', 'channel', 'date_available',
-                    'date_end', 'site', 'login_required', 'published', 'preview_url']
-    list_filter = ["date_end", "date_available", "published", "channel"]
+                    'date_end', 'status', 'site', 'login_required', 'published',
+                    'answer_count', 'winner_count', 'preview_url']
+    list_filter = ["date_end", "date_available", "published", "status", "channel"]
     search_fields = ["title", "headline", "description"]
     exclude = ('user',)
     raw_id_fields = ['main_image', 'banner', 'channel']
@@ -81,6 +118,7 @@ class PromoAdmin(PublishableAdmin, AdminViewPermission):
                        'order', 'form_type',
                        'display_answers',
                        'countdown_enabled',
+                       'rate_limits',
                        'mirror_site')}),
 
         (_(u'Participation'), {
@@ -93,6 +131,17 @@ class PromoAdmin(PublishableAdmin, AdminViewPermission):
     )
 
     readonly_fields = ['image_thumb', 'banner_thumb']
+    actions = list(PublishableAdmin.actions or []) + ['notify_winners']
+
+    def notify_winners(self, request, queryset):
+        queued = 0
+        for promo in queryset:
+            queued += queue_winner_notifications(promo)
+        if queued:
+            schedule_outbox_delivery()
+        self.message_user(request, _(u"%d winner notification(s) queued.") %
+                          queued)
+    notify_winners.short_description = _(u'Notify winners')
 
     def banner_thumb(self, obj):
         if obj.banner:
@@ -133,16 +182,153 @@ class AnswerAdmin(AdminViewPermission, ImportExportModelAdmin):
     search_fields = ["answer", "user__email", "answer_url"]
     raw_id_fields = ['promo', 'user']
     readonly_fields = ('user_anony_data',)
+    actions = ['export_csv', 'export_xlsx']
 
     def queryset(self, request):
         qs = super(AnswerAdmin, self).queryset(request)
         return qs.select_related('promo').prefetch_related('user')
 
+    def get_actions(self, request):
+        actions = super(AnswerAdmin, self).get_actions(request)
+        if 'xlsx' not in supported_formats():
+            actions.pop('export_xlsx', None)
+        return actions
+
+    def export_action(self, request, *args, **kwargs):
+        # CSV and XLSX are streamed from chunked queries instead of
+        # building the whole dataset in memory with tablib
+        formats = self.get_export_formats()
+        form = ExportForm(formats, request.POST or None)
+        if form.is_valid():
+            file_format = formats[int(form.cleaned_data['file_format'])]()
+            extension = file_format.get_extension()
+            if extension in supported_formats():
+                response = self.export_answers(
+                    request, self.get_export_queryset(request), extension)
+                return response or HttpResponseRedirect(
+                    request.get_full_path())
+        return super(AnswerAdmin, self).export_action(request, *args,
+                                                      **kwargs)
+
+    def export_answers(self, request, queryset, extension):
+        try:
+            return export_response(self.get_resource_class()(), queryset,
+                                   extension)
+        except ExportTooLarge:
+            self.message_user(
+                request,
+                _(u"XLSX exports are limited to %d answers, export them to "
+                  u"CSV or add an answer export instead.") %
+                EXPORT_XLSX_MAX_ROWS,
+                level=messages.ERROR)
+
+    def export_csv(self, request, queryset):
+        return self.export_answers(request, queryset, 'csv')
+    export_csv.short_description = _(u'Export selected answers to CSV')
+
+    def export_xlsx(self, request, queryset):
+        return self.export_answers(request, queryset, 'xlsx')
+    export_xlsx.short_description = lazy(
+        lambda: _(u'Export selected answers to XLSX (up to %d)') %
+        EXPORT_XLSX_MAX_ROWS if EXPORT_XLSX_MAX_ROWS else
+        _(u'Export selected answers to XLSX'), unicode)()
+
     def image_thumb(self, obj):
         return obj.get_file_display()
     image_thumb.short_description = _(u'Upload')
     image_thumb.allow_tags = True
 
 
+class OutboxAdmin(admin.ModelAdmin):
+    list_display = ['answer', 'kind', 'status', 'attempts', 'date_insert',
+                    'date_sent', 'error']
+    list_filter = ['status', 'kind', 'date_insert']
+    raw_id_fields = ['answer']
+    readonly_fields = ['answer', 'kind', 'status', 'attempts', 'error',
+                       'date_claimed', 'date_sent']
+    actions = ['send_again']
+
+    def queryset(self, request):
+        qs = super(OutboxAdmin, self).queryset(request)
+        return qs.select_related('answer__promo')
+
+    def send_again(self, request, queryset):
+        updated = queryset.exclude(status=Outbox.STATUS_SENDING).update(
+            status=Outbox.STATUS_PENDING, attempts=0, claim=None,
+            date_claimed=None, error=u'')
+        self.message_user(request, _(u"%d email(s) queued again.") % updated)
+    send_again.short_description = _(u'Send again')
+
+
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ['__unicode__', 'status', 'progress_display', 'download',
+                    'user', 'date_insert', 'date_finished']
+    list_filter = ['status', 'date_insert']
+    raw_id_fields = ['promo']
+    fields = ['promo']
+
+    def queryset(self, request):
+        qs = super(ExportJobAdmin, self).queryset(request)
+        return qs.select_related('promo', 'user')
+
+    def get_readonly_fields(self, request, obj=None):
+        if obj:
+            return ['promo', 'status', 'progress_display', 'download',
+                    'error']
+        return []
+
+    def get_fieldsets(self, request, obj=None):
+        return [(None, {'fields': self.get_readonly_fields(request, obj) or
+                        self.fields})]
+
+    def get_urls(self):
+        urls = patterns(
+            '',
+            url(r'^(\d+)/download/$',
+                self.admin_site.admin_view(self.download_view),
+                name='promos_exportjob_download'),
+        )
+        return urls + super(ExportJobAdmin, self).get_urls()
+
+    def download_view(self, request, object_id):
+        """
+        Serve the export file to staff allowed to see the jobs, as the
+        export storage is not meant to be reachable by URL.
+        """
+        job = get_object_or_404(self.queryset(request), pk=object_id)
+        if not self.has_change_permission(request, job):
+            raise PermissionDenied
+        if job.status != ExportJob.STATUS_DONE or not job.file:
+            raise Http404
+        response = StreamingHttpResponse(
+            FileWrapper(job.file.storage.open(job.file.name)),
+            content_type='application/x-gzip')
+        response['Content-Disposition'] = \
+            'attachment; filename=answers-{0}.csv.gz'.format(job.pk)
+        return response
+
+    def save_model(self, request, obj, form, change):
+        if change:
+            return
+        obj.user = request.user
+        obj.save()
+        start_export_job(obj)
+
+    def progress_display(self, obj):
+        return u'{0}%'.format(obj.progress)
+    progress_display.short_description = _(u'Progress')
+
+    def download(self, obj):
+        if obj.status != ExportJob.STATUS_DONE or not obj.file:
+            return u''
+        return u'<a href="{0}">{1}</a>'.format(
+            reverse('admin:promos_exportjob_download', args=[obj.pk]),
+            _(u'Download'))
+    download.short_description = _(u'File')
+    download.allow_tags = True
+
+
 admin.site.register(Promo, PromoAdmin)
 admin.site.register(Answer, AnswerAdmin)
+admin.site.register(Outbox, OutboxAdmin)
+admin.site.register(ExportJob, ExportJobAdmin)
@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""
+Write-behind ingestion of answers for flash promos.
+
+With ``OPPS_PROMOS_ANSWER_BUFFER`` set to ``'memory'`` or ``'cache'``,
+PromoDetail validates answers synchronously and appends them here instead
+of inserting them one by one. Buffered answers are written with
+``bulk_create`` once ``OPPS_PROMOS_ANSWER_BUFFER_BATCH_SIZE`` of them are
+pending or ``OPPS_PROMOS_ANSWER_BUFFER_WINDOW`` seconds went by since the
+last flush.
+
+Entries are only removed from the buffer after they are written, so a
+crash mid flush writes them again; receipts and participation keys are
+used to drop those duplicates. The ``'cache'`` backend needs a shared,
+non evicting cache (e.g. redis) and can be drained from any process with
+``manage.py drain_answer_buffer``. The ``'memory'`` backend is flushed by
+a background thread every window and on interpreter exit; answers it
+holds are lost if the process is killed (SIGKILL, hard worker recycling),
+so production deployments should use ``'cache'``.
+"""
+import atexit
+import collections
+import itertools
+import logging
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from .cache import (make_key, bump_promo_version, VERSION_TIMEOUT,
+                    CACHE_TIMEOUT)
+from .signals import answers_written
+from .models import (Promo, Answer, answer_counter_state,
+                     update_answer_counters, displayed_promo_ids,
+                     participation_cache_key)
+
+logger = logging.getLogger(__name__)
+
+BUFFER_BACKEND = getattr(settings, 'OPPS_PROMOS_ANSWER_BUFFER', None)
+BUFFER_BATCH_SIZE = getattr(
+    settings, 'OPPS_PROMOS_ANSWER_BUFFER_BATCH_SIZE', 500)
+BUFFER_WINDOW = getattr(settings, 'OPPS_PROMOS_ANSWER_BUFFER_WINDOW', 2)
+
+# an index reserved by a writer that never stored its entry is skipped
+# after this many seconds
+HOLE_TIMEOUT = 60
+
+
+RECEIPT_PENDING = 'pending'
+RECEIPT_PERSISTED = 'persisted'
+RECEIPT_REJECTED = 'rejected'
+RECEIPT_UNKNOWN = 'unknown'
+
+
+def receipt_cache_key(receipt):
+    return make_key('receipt', receipt)
+
+
+def get_receipt_status(receipt):
+    """
+    Whether an accepted answer was written. Answered from the cache while
+    its entry lives, so polling rarely reaches the database.
+    """
+    status = cache.get(receipt_cache_key(receipt))
+    if status is None:
+        if Answer.objects.filter(receipt=receipt).exists():
+            status = RECEIPT_PERSISTED
+        else:
+            status = RECEIPT_UNKNOWN
+    return status
+
+
+def serialize_answer(answer):
+    """
+    Return the field values of an unsaved answer as a picklable dict,
+    storing its uploaded file first. A receipt is assigned if missing.
+    """
+    if answer.answer_file and not answer.answer_file._committed:
+        # FileField.pre_save commits the upload to the storage
+        Answer._meta.get_field('answer_file').pre_save(answer, True)
+
+    answer.receipt = answer.receipt or uuid.uuid4().hex
+    # written as is by bulk_create, however late the flush
+    answer.date_insert = answer.date_insert or timezone.now()
+
+    data = {}
+    for field in Answer._meta.local_fields:
+        if field.primary_key:
+            continue
+        data[field.attname] = getattr(answer, field.attname)
+    data['answer_file'] = answer.answer_file.name or None
+    return data
+
+
+def accept_answer(answer):
+    """
+    Serialize an answer that will be written later, marking its receipt
+    as pending and its user as having answered.
+    """
+    data = serialize_answer(answer)
+    cache.set(receipt_cache_key(data['receipt']), RECEIPT_PENDING,
+              CACHE_TIMEOUT)
+    if answer.user_id:
+        cache.set(participation_cache_key(answer.promo_id, answer.user_id),
+                  True, CACHE_TIMEOUT)
+    return data
+
+
+def write_answers(items):
+    """
+    Insert serialized answers with bulk_create, skipping receipts that
+    were already written and participations that already exist, and
+    record the outcome of every receipt. Returns the written answers.
+    """
+    promos = Promo.objects.in_bulk(set(data['promo_id'] for data in items))
+
+    answers, receipts, keys = [], set(), set()
+    for data in items:
+        answer = Answer(**data)
+        if answer.promo_id not in promos or answer.receipt in receipts:
+            continue
+        answer.promo = promos[answer.promo_id]
+        answer.set_participation_key()
+        if answer.participation_key in keys:
+            continue
+        receipts.add(answer.receipt)
+        if answer.participation_key:
+            keys.add(answer.participation_key)
+        answers.append(answer)
+
+    existing_receipts = set(Answer.objects.filter(
+        receipt__in=receipts).values_list('receipt', flat=True))
+    existing_keys = set(Answer.objects.filter(
+        participation_key__in=keys).values_list('participation_key',
+                                                flat=True))
+    answers = [a for a in answers
+               if a.receipt not in existing_receipts and
+               a.participation_key not in existing_keys]
+
+    if answers:
+        sid = transaction.savepoint()
+        try:
+            Answer.objects.bulk_create(answers)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # another process wrote some of them meanwhile, go one by one
+            transaction.savepoint_rollback(sid)
+            answers = [a for a in answers if _insert(a)]
+
+        # bulk_create sends no signals, do what the post_save handlers do
+        changes = [(None, answer_counter_state(a)) for a in answers]
+        update_answer_counters(*changes)
+        bump_promo_version(*displayed_promo_ids(*changes))
+        cache.set_many(dict(
+            (participation_cache_key(a.promo_id, a.user_id), True)
+            for a in answers if a.user_id), CACHE_TIMEOUT)
+
+        answers_written.send(sender=Answer, answers=answers)
+
+    persisted = existing_receipts.union(a.receipt for a in answers)
+    cache.set_many(dict(
+        (receipt_cache_key(data['receipt']),
+         RECEIPT_PERSISTED if data['receipt'] in persisted
+         else RECEIPT_REJECTED)
+        for data in items), CACHE_TIMEOUT)
+    return answers
+
+
+def _insert(answer):
+    sid = transaction.savepoint()
+    try:
+        Answer.objects.bulk_create([answer])
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        return False
+    transaction.savepoint_commit(sid)
+    return True
+
+
+class MemoryBackend(object):
+
+    def __init__(self):
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.last_flush = time.time()
+
+    def __len__(self):
+        return len(self._items)
+
+    def append(self, data):
+        with self._lock:
+            self._items.append(data)
+
+    def peek(self, count):
+        """
+        Return ``(consumed, items)`` for the next entries, without
+        removing them.
+        """
+        with self._lock:
+            items = list(itertools.islice(self._items, count))
+        return len(items), items
+
+    def ack(self, consumed):
+        with self._lock:
+            for i in range(consumed):
+                self._items.popleft()
+
+    def acquire(self):
+        return self._flush_lock.acquire(False)
+
+    def release(self):
+        self.last_flush = time.time()
+        self._flush_lock.release()
+
+
+class CacheBackend(object):
+    """
+    Queue kept in Django's cache: writers reserve an index with incr()
+    and store their entry under it, the flusher reads from the head.
+    """
+
+    def __init__(self, name='answers'):
+        self.name = name
+
+    def key(self, *parts):
+        return make_key('buffer', self.name, *parts)
+
+    def _get_int(self, name):
+        return cache.get(self.key(name)) or 0
+
+    def __len__(self):
+        return max(0, self._get_int('tail') - self._get_int('head'))
+
+    @property
+    def last_flush(self):
+        return cache.get(self.key('last_flush')) or 0
+
+    def append(self, data):
+        cache.add(self.key('tail'), 0, VERSION_TIMEOUT)
+        index = cache.incr(self.key('tail'))
+        cache.set(self.key('item', index), data, VERSION_TIMEOUT)
+
+    def peek(self, count):
+        head, tail = self._get_int('head'), self._get_int('tail')
+        indexes = range(head + 1, min(tail, head + count) + 1)
+        if not indexes:
+            return 0, []
+
+        found = cache.get_many([self.key('item', i) for i in indexes])
+        consumed, items = 0, []
+        for index in indexes:
+            data = found.get(self.key('item', index))
+            if data is None:
+                if consumed or not self._is_stale_hole(index):
+                    break
+            else:
+                items.append(data)
+            consumed += 1
+        return consumed, items
+
+    def _is_stale_hole(self, index):
+        key = self.key('hole', index)
+        cache.add(key, time.time(), VERSION_TIMEOUT)
+        return time.time() - (cache.get(key) or time.time()) > HOLE_TIMEOUT
+
+    def ack(self, consumed):
+        head = self._get_int('head')
+        cache.set(self.key('head'), head + consumed, VERSION_TIMEOUT)
+        cache.delete_many([self.key('item', i)
+                           for i in range(head + 1, head + consumed + 1)])
+
+    def acquire(self):
+        return cache.add(self.key('lock'), True, 5 * 60)
+
+    def release(self):
+        cache.set(self.key('last_flush'), time.time(), VERSION_TIMEOUT)
+        cache.delete(self.key('lock'))
+
+
+class Flusher(threading.Thread):
+    """
+    Daemon thread flushing a buffer every window, so the last answers of
+    a quiet period do not wait for the next submission.
+    """
+
+    def __init__(self, answer_buffer):
+        super(Flusher, self).__init__(name='opps-promos-answer-flusher')
+        self.daemon = True
+        self.answer_buffer = answer_buffer
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.answer_buffer.window):
+            if len(self.answer_buffer):
+                self.answer_buffer.flush()
+                # connections are per thread, do not keep this one idle
+                connection.close()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class AnswerBuffer(object):
+
+    def __init__(self, backend, batch_size=BUFFER_BATCH_SIZE,
+                 window=BUFFER_WINDOW, background=False):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.window = window
+        self.background = background
+        self.flusher = None
+        self._flusher_pid = None
+        self._flusher_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.backend)
+
+    def append(self, answer):
+        """
+        Buffer a validated, unsaved answer and return its receipt.
+        """
+        data = accept_answer(answer)
+        self.backend.append(data)
+        if self.background:
+            self.start_flusher()
+        self.maybe_flush()
+        return data['receipt']
+
+    def start_flusher(self):
+        """
+        Start the background flusher, once per process: started lazily so
+        workers forked from a preloading server get their own.
+        """
+        pid = os.getpid()
+        if self._flusher_pid == pid and self.flusher.is_alive():
+            return
+        with self._flusher_lock:
+            if self._flusher_pid != pid or not self.flusher.is_alive():
+                self.flusher = Flusher(self)
+                self.flusher.start()
+                self._flusher_pid = pid
+
+    def maybe_flush(self):
+        if len(self.backend) >= self.batch_size or \
+                time.time() - self.backend.last_flush >= self.window:
+            self.flush()
+
+    def flush(self):
+        """
+        Write pending answers batch by batch until the buffer is empty or
+        another flusher holds the lock. Returns the written answers.
+        """
+        if not self.backend.acquire():
+            return []
+
+        written = []
+        try:
+            while True:
+                consumed, items = self.backend.peek(self.batch_size)
+                if not consumed:
+                    break
+                if items:
+                    written.extend(write_answers(items))
+                self.backend.ack(consumed)
+        except Exception:
+            logger.exception(u"Failed to flush buffered answers")
+        finally:
+            self.backend.release()
+        return written
+
+
+def get_answer_buffer():
+    if BUFFER_BACKEND == 'memory':
+        answer_buffer = AnswerBuffer(MemoryBackend(), background=True)
+        atexit.register(answer_buffer.flush)
+        return answer_buffer
+    if BUFFER_BACKEND == 'cache':
+        return AnswerBuffer(CacheBackend())
+    return None
+
+
+answer_buffer = get_answer_buffer()
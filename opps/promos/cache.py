@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+
+CACHE_PREFIX = getattr(settings, 'OPPS_PROMOS_CACHE_PREFIX', 'opps_promos')
+CACHE_TIMEOUT = getattr(settings, 'OPPS_PROMOS_CACHE_TIMEOUT', 60 * 60)
+
+# version counters must outlive the entries keyed on them
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def make_key(*parts):
+    return u':'.join([CACHE_PREFIX] + [unicode(part) for part in parts])
+
+
+def _now_version():
+    return int(time.time() * 1000)
+
+
+def get_version(*parts):
+    """
+    Return the version counter stored under ``parts``. Versions are
+    millisecond timestamps, so a counter lost to eviction is recreated
+    with a value newer than anything cached before it.
+    """
+    key = make_key('version', *parts)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _now_version(), VERSION_TIMEOUT)
+        version = cache.get(key) or _now_version()
+    return version
+
+
+def bump_version(*parts):
+    key = make_key('version', *parts)
+    version = max(_now_version(), (cache.get(key) or 0) + 1)
+    cache.set(key, version, VERSION_TIMEOUT)
+    return version
+
+
+def get_generation(site_id):
+    """
+    Promo generation of a site, bumped whenever a promo published on it
+    (directly or as a mirror) is saved or deleted.
+    """
+    return get_version('generation', site_id)
+
+
+def bump_generation(*site_ids):
+    for site_id in set(site_ids):
+        bump_version('generation', site_id)
+
+
+def get_promo_version(promo_id):
+    """
+    Content version of a promo page, bumped when its published answers
+    change. Changes to the promo itself bump the site generation.
+    """
+    return get_version('promo', promo_id)
+
+
+def bump_promo_version(*promo_ids):
+    for promo_id in set(promo_ids):
+        bump_version('promo', promo_id)
+
+
+RESPONSE_CACHE_TIMEOUT = getattr(
+    settings, 'OPPS_PROMOS_RESPONSE_CACHE_TIMEOUT', 0)
+RESPONSE_CACHE_STALE = getattr(settings, 'OPPS_PROMOS_RESPONSE_CACHE_STALE', 30)
+
+CSRF_PLACEHOLDER = '<!--opps-promos-csrf-token-->'
+
+
+class ResponseCache(object):
+    """
+    Rendered responses kept under a content version. An entry is fresh for
+    ``timeout`` seconds while its version is current; past that a single
+    request renders it again while the others are served the stale entry
+    for up to ``stale`` more seconds, so an expiry never stampedes the
+    database.
+    """
+
+    def __init__(self, timeout=RESPONSE_CACHE_TIMEOUT,
+                 stale=RESPONSE_CACHE_STALE):
+        self.timeout = timeout
+        self.stale = stale
+
+    def get_key(self, request, site_id):
+        query = u'&'.join(u'{0}={1}'.format(name, value)
+                          for name, value in sorted(request.GET.items()))
+        path = hashlib.md5(u'{0}?{1}'.format(request.path, query).encode(
+            'utf-8')).hexdigest()
+        return make_key('response', site_id, path)
+
+    def get_response(self, request, key, version, render):
+        """
+        Return the cached response under ``key`` for ``version``, calling
+        ``render`` to build it when missing or out of date.
+        """
+        entry = cache.get(key)
+        now = time.time()
+        if entry and entry['version'] == version and entry['expires'] > now:
+            return self.build(request, entry)
+
+        lock = u'{0}:lock'.format(key)
+        if not cache.add(lock, True, self.stale or self.timeout):
+            # another request is rendering it
+            if entry and entry['expires'] + self.stale > now:
+                return self.build(request, entry)
+            return render()
+
+        try:
+            response = render()
+            self.store(request, key, version, response)
+        finally:
+            cache.delete(lock)
+        return response
+
+    def store(self, request, key, version, response):
+        if hasattr(response, 'render') and callable(response.render):
+            response.render()
+        if response.status_code != 200 or response.cookies or \
+                getattr(response, 'streaming', False):
+            return
+
+        content, csrf = response.content, False
+        token = request.META.get('CSRF_COOKIE')
+        if token and request.META.get('CSRF_COOKIE_USED'):
+            # the token belongs to this visitor, put back on every serve
+            content, csrf = content.replace(token, CSRF_PLACEHOLDER), True
+
+        cache.set(key, {
+            'version': version,
+            'expires': time.time() + self.timeout,
+            'content': content,
+            'content_type': response['Content-Type'],
+            'csrf': csrf,
+        }, self.timeout + self.stale)
+
+    def build(self, request, entry):
+        content = entry['content']
+        if entry['csrf']:
+            content = content.replace(CSRF_PLACEHOLDER, get_token(request))
+        return HttpResponse(content, content_type=entry['content_type'])
+
+
+response_cache = ResponseCache()
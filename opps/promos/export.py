@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Constant memory exports of answers.
+
+Rows are read in primary key ranges of ``OPPS_PROMOS_EXPORT_CHUNK_SIZE``
+with their promo and user joined, formatted one by one by the admin's
+import_export resource (so its ``dehydrate_*`` methods still apply) and
+written to a ``StreamingHttpResponse``.
+
+Exports too long for a request run as ExportJob: the id space is split in
+ranges of ``OPPS_PROMOS_EXPORT_RANGE_SIZE`` exported by a process pool
+into gzip shards, which concatenate into a single gzip file.
+"""
+import csv
+import gzip
+import multiprocessing
+import os
+import shutil
+import tempfile
+import uuid
+
+from django.conf import settings
+from django.core.files import File
+from django.core.servers.basehttp import FileWrapper
+from django.db import connections
+from django.db.models import F, Max, Min
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from .models import Answer, ExportJob, export_storage
+
+try:
+    from openpyxl import Workbook
+except ImportError:
+    Workbook = None
+
+EXPORT_CHUNK_SIZE = getattr(settings, 'OPPS_PROMOS_EXPORT_CHUNK_SIZE', 2000)
+EXPORT_RANGE_SIZE = getattr(settings, 'OPPS_PROMOS_EXPORT_RANGE_SIZE', 50000)
+EXPORT_PROCESSES = getattr(settings, 'OPPS_PROMOS_EXPORT_PROCESSES', 4)
+EXPORT_XLSX_MAX_ROWS = getattr(settings, 'OPPS_PROMOS_EXPORT_XLSX_MAX_ROWS',
+                               50000)
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.'
+            'spreadsheetml.sheet',
+}
+
+
+class ExportTooLarge(ValueError):
+    """
+    Raised for XLSX exports of more than ``OPPS_PROMOS_EXPORT_XLSX_MAX_ROWS``
+    answers, which would be built whole within the request.
+    """
+
+
+def iter_chunks(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield the objects of ``queryset`` by primary key ranges, each read
+    with iterator() so no more than a chunk is held at once.
+    """
+    queryset = queryset.select_related('promo', 'user').order_by('pk')
+    last = None
+    while True:
+        chunk = queryset if last is None else queryset.filter(pk__gt=last)
+        count = 0
+        for obj in chunk[:chunk_size].iterator():
+            count += 1
+            last = obj.pk
+            yield obj
+        if count < chunk_size:
+            break
+
+
+def iter_rows(resource, queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    yield resource.get_export_headers()
+    for obj in iter_chunks(queryset, chunk_size):
+        yield resource.export_resource(obj)
+
+
+def encode(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class Echo(object):
+    """
+    File-like object handing back what csv.writer writes to it.
+    """
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows):
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow([encode(value) for value in row])
+
+
+def write_xlsx(rows, output):
+    """
+    Write ``rows`` to ``output`` with openpyxl's write only mode, which
+    spools rows to disk instead of keeping them in memory.
+    """
+    try:
+        workbook = Workbook(write_only=True)
+    except TypeError:
+        # openpyxl before 2.0
+        workbook = Workbook(optimized_write=True)
+    sheet = workbook.create_sheet()
+    for row in rows:
+        sheet.append(list(row))
+    workbook.save(output)
+
+
+def export_filename(extension):
+    return u'answers-{0}.{1}'.format(
+        timezone.now().strftime('%Y-%m-%d-%H%M%S'), extension)
+
+
+def export_response(resource, queryset, extension,
+                    chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Return a StreamingHttpResponse exporting ``queryset`` as ``csv`` or
+    ``xlsx``. XLSX needs openpyxl and is built in a temporary file before
+    anything is sent, as the format cannot be written sequentially, so it
+    raises ExportTooLarge past ``EXPORT_XLSX_MAX_ROWS`` answers; larger
+    exports go to CSV or to an ExportJob.
+    """
+    rows = iter_rows(resource, queryset, chunk_size)
+    if extension == 'csv':
+        content = stream_csv(rows)
+    elif extension == 'xlsx' and Workbook is not None:
+        if EXPORT_XLSX_MAX_ROWS and \
+                queryset.count() > EXPORT_XLSX_MAX_ROWS:
+            raise ExportTooLarge(
+                u"XLSX exports are limited to {0} answers".format(
+                    EXPORT_XLSX_MAX_ROWS))
+        output = tempfile.TemporaryFile()
+        write_xlsx(rows, output)
+        output.seek(0)
+        content = FileWrapper(output)
+    else:
+        raise ValueError(u"Unsupported export format: {0}".format(extension))
+
+    response = StreamingHttpResponse(content,
+                                     content_type=CONTENT_TYPES[extension])
+    response['Content-Disposition'] = 'attachment; filename={0}'.format(
+        export_filename(extension))
+    return response
+
+
+def supported_formats():
+    return ['csv', 'xlsx'] if Workbook is not None else ['csv']
+
+
+def get_ranges(queryset, size=EXPORT_RANGE_SIZE):
+    """
+    Split the ids of ``queryset`` into ``(start, end)`` ranges, end
+    excluded, from its lowest to its highest id.
+    """
+    bounds = queryset.aggregate(low=Min('pk'), high=Max('pk'))
+    if bounds['low'] is None:
+        return []
+    return [(start, start + size)
+            for start in range(bounds['low'], bounds['high'] + 1, size)]
+
+
+def write_gzip(path, rows):
+    output = gzip.open(path, 'wb')
+    try:
+        for line in stream_csv(rows):
+            output.write(line)
+    finally:
+        output.close()
+
+
+def export_shard(args):
+    """
+    Write the answers of ``promo_id`` (all promos when None) with ids in
+    ``[start, end)`` as a gzip CSV shard at ``path``. Runs in the pool.
+    """
+    from .admin import AnswerResource
+    promo_id, start, end, path = args
+    queryset = Answer.objects.filter(pk__gte=start, pk__lt=end)
+    if promo_id:
+        queryset = queryset.filter(promo=promo_id)
+    resource = AnswerResource()
+    write_gzip(path, (resource.export_resource(obj)
+                      for obj in iter_chunks(queryset)))
+    return path
+
+
+def map_shards(shards, processes):
+    """
+    Yield as ``shards`` get exported, by a pool of ``processes`` when
+    more than one is asked for and this process may have children.
+    """
+    if processes < 2 or len(shards) < 2 or \
+            multiprocessing.current_process().daemon:
+        for shard in shards:
+            yield export_shard(shard)
+        return
+
+    # the children must not share the connections of this process
+    for connection in connections.all():
+        connection.close()
+    pool = multiprocessing.Pool(min(processes, len(shards)))
+    try:
+        for path in pool.imap_unordered(export_shard, shards):
+            yield path
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def run_export(job, processes=EXPORT_PROCESSES, range_size=EXPORT_RANGE_SIZE):
+    """
+    Export the answers of ``job`` to ``promos/exports/`` in the export
+    storage, updating its progress as id ranges complete. The name holds
+    a random token so it cannot be guessed from the job id.
+    """
+    from .admin import AnswerResource
+    jobs = ExportJob.objects.filter(pk=job.pk)
+    queryset = Answer.objects.all()
+    if job.promo_id:
+        queryset = queryset.filter(promo=job.promo_id)
+    ranges = get_ranges(queryset, range_size)
+    jobs.update(status=ExportJob.STATUS_RUNNING, ranges=len(ranges),
+                ranges_done=0, error=u'')
+
+    workdir = tempfile.mkdtemp(prefix='promos-export-')
+    try:
+        header = os.path.join(workdir, 'header.gz')
+        write_gzip(header, [AnswerResource().get_export_headers()])
+        shards = [(job.promo_id, start, end,
+                   os.path.join(workdir, '{0}.gz'.format(i)))
+                  for i, (start, end) in enumerate(ranges)]
+        for path in map_shards(shards, processes):
+            jobs.update(ranges_done=F('ranges_done') + 1)
+
+        # gzip members concatenate into a valid gzip file
+        path = os.path.join(workdir, 'answers.csv.gz')
+        with open(path, 'wb') as output:
+            for shard in [header] + [shard[3] for shard in shards]:
+                with open(shard, 'rb') as member:
+                    shutil.copyfileobj(member, output)
+        with open(path, 'rb') as output:
+            name = export_storage.save(
+                u'promos/exports/{0}/answers-{1}.csv.gz'.format(
+                    uuid.uuid4().hex, job.pk),
+                File(output))
+    except Exception as e:
+        jobs.update(status=ExportJob.STATUS_FAILED, error=unicode(e),
+                    date_finished=timezone.now())
+        raise
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    jobs.update(status=ExportJob.STATUS_DONE, file=name,
+                ranges_done=len(ranges), date_finished=timezone.now())
+    return name
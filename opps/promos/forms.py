@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
+from importlib import import_module
 
 from django import forms
+from django.forms.formsets import formset_factory
+from django.forms.models import modelform_factory
 from django.utils.translation import ugettext_lazy as _
 
-from .models import Answer
+from .models import Answer, Promo, ANONY_USER_FORM
 
 
 class BaseAnswerForm(forms.ModelForm):
@@ -31,3 +34,69 @@ class AnonyUserForm(forms.Form):
     name = forms.CharField(label=_('name'), max_length=200)
     birthday = forms.DateField(label=_('birthday'))
     email = forms.EmailField(label=_("e-mail"))
+
+
+class FormRegistry(object):
+    """
+    Process-wide cache of the answer form class of each promo form type
+    and of the anonymous user form and formsets, so they are built once
+    instead of on every request. Hit/miss counters are not locked and
+    are meant for monitoring only.
+    """
+
+    ANSWER_FIELDS = (
+        ('text', 'answer'),
+        ('url', 'answer_url'),
+        ('upload', 'answer_file'),
+    )
+
+    def __init__(self):
+        self._forms = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key, build):
+        try:
+            form = self._forms[key]
+        except KeyError:
+            self.misses += 1
+            form = self._forms.setdefault(key, build())
+        else:
+            self.hits += 1
+        return form
+
+    def _build_answer_form(self, form_type):
+        types = form_type.split('|')
+        fields = [field for name, field in self.ANSWER_FIELDS
+                  if name in types]
+        return modelform_factory(Answer, form=BaseAnswerForm, fields=fields)
+
+    def get_answer_form(self, form_type):
+        return self._get(('answer', form_type),
+                         lambda: self._build_answer_form(form_type))
+
+    def get_anony_user_form(self):
+        def build():
+            mod, cls_name = ANONY_USER_FORM.rsplit('.', 1)
+            return getattr(import_module(mod), cls_name)
+        return self._get('anony_user', build)
+
+    def get_formset(self, form_class):
+        return self._get(('formset', form_class), lambda: formset_factory(
+            form_class, max_num=1, extra=1, can_delete=False))
+
+    def warm(self):
+        for form_type, label in Promo.FORM_TYPES:
+            self.get_answer_form(form_type)
+        self.get_formset(self.get_anony_user_form())
+
+    def clear(self):
+        self._forms.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._forms)}
+
+
+form_registry = FormRegistry()
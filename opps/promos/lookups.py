@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Evaluate simple queryset lookups against model instances already in
+memory, so several filter sets can be served from one query.
+"""
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.fields.related import ForeignKey
+
+LOOKUPS = {
+    'exact': lambda value, arg: value == arg,
+    'iexact': lambda value, arg: value is not None and
+    unicode(value).lower() == unicode(arg).lower(),
+    'in': lambda value, arg: value in arg,
+    'isnull': lambda value, arg: (value is None) == bool(arg),
+    'gt': lambda value, arg: value is not None and value > arg,
+    'gte': lambda value, arg: value is not None and value >= arg,
+    'lt': lambda value, arg: value is not None and value < arg,
+    'lte': lambda value, arg: value is not None and value <= arg,
+    'contains': lambda value, arg: value is not None and
+    unicode(arg) in unicode(value),
+    'icontains': lambda value, arg: value is not None and
+    unicode(arg).lower() in unicode(value).lower(),
+    'startswith': lambda value, arg: value is not None and
+    unicode(value).startswith(unicode(arg)),
+}
+
+
+class UnsupportedLookup(Exception):
+    pass
+
+
+def _coerce(field, op, arg):
+    if op == 'isnull':
+        return arg
+    if isinstance(field, ForeignKey):
+        convert = lambda v: getattr(v, 'pk', v)
+        field = field.rel.get_related_field()
+    else:
+        convert = lambda v: v
+    try:
+        if op == 'in':
+            return [field.to_python(convert(v)) for v in arg]
+        if op in ('contains', 'icontains', 'startswith', 'iexact'):
+            return arg
+        return field.to_python(convert(arg))
+    except Exception:
+        raise UnsupportedLookup(op)
+
+
+def matches(obj, lookup, arg):
+    """
+    Whether ``obj`` passes ``filter(**{lookup: arg})``. Lookups may follow
+    foreign keys whose objects are already loaded (select_related), and
+    raise UnsupportedLookup for anything else, including values Python
+    cannot compare.
+    """
+    parts = lookup.split('__')
+    op = 'exact'
+    if len(parts) > 1 and parts[-1] in LOOKUPS:
+        op = parts.pop()
+
+    for i, name in enumerate(parts):
+        if name == 'pk':
+            name = obj._meta.pk.name
+        try:
+            field = obj._meta.get_field(name)
+        except FieldDoesNotExist:
+            raise UnsupportedLookup(lookup)
+
+        if i == len(parts) - 1:
+            if field.rel and not isinstance(field, ForeignKey):
+                raise UnsupportedLookup(lookup)
+            value = getattr(obj, field.attname)
+            try:
+                return LOOKUPS[op](value, _coerce(field, op, arg))
+            except (TypeError, ValueError):
+                # e.g. an aware datetime against a naive one or a string,
+                # which the database compares fine
+                raise UnsupportedLookup(lookup)
+
+        cache_name = field.get_cache_name() \
+            if isinstance(field, ForeignKey) else None
+        if cache_name is None or not hasattr(obj, cache_name):
+            raise UnsupportedLookup(lookup)
+        obj = getattr(obj, cache_name)
+        if obj is None:
+            # the database would need an outer join here
+            raise UnsupportedLookup(lookup)
+
+
+def filter_objects(objects, filters, exclude=False):
+    """
+    In memory ``filter(**filters)`` or ``exclude(**filters)`` over
+    ``objects``, keeping their order.
+    """
+    result = []
+    for obj in objects:
+        matched = all(matches(obj, lookup, arg)
+                      for lookup, arg in filters.items())
+        if matched != exclude:
+            result.append(obj)
+    return result
@@ -0,0 +1,465 @@
+# -*- coding: utf-8 -*-
+"""
+Entrant emails, delivered from the Outbox table.
+
+Entries are written in the transaction that saves their answers and sent
+by ``deliver_outbox``, which claims ``OPPS_PROMOS_EMAIL_BATCH_SIZE``
+entries at a time, groups them per promo so each promo's subject and
+bodies are built once, and sends them over one connection, at most
+``OPPS_PROMOS_EMAIL_RATE`` messages per second when set. Several workers
+can deliver at once, each only sends the entries it claimed.
+
+An entry is sent at most once: one interrupted while being sent is
+marked failed instead of being sent again.
+"""
+import collections
+import logging
+import smtplib
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db.models import Count, Q
+from django.template import Context, Template, TemplateSyntaxError
+from django.template.loader import select_template
+from django.utils.text import Truncator
+from django.utils import timezone
+from django.utils.translation import ugettext as _
+
+from .cache import make_key, VERSION_TIMEOUT
+from .models import Answer, Outbox
+
+logger = logging.getLogger(__name__)
+
+EMAIL_BATCH_SIZE = getattr(settings, 'OPPS_PROMOS_EMAIL_BATCH_SIZE', 100)
+EMAIL_WINDOW = getattr(settings, 'OPPS_PROMOS_EMAIL_WINDOW', 5)
+EMAIL_RATE = getattr(settings, 'OPPS_PROMOS_EMAIL_RATE', None)
+EMAIL_MAX_ATTEMPTS = getattr(settings, 'OPPS_PROMOS_EMAIL_MAX_ATTEMPTS', 5)
+
+# entries claimed longer ago were left behind by a dead worker
+CLAIM_TIMEOUT = 10 * 60
+# failed attempts are retried after this many seconds
+RETRY_DELAY = 5 * 60
+
+# errors about a single message, the connection is still usable
+MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                  smtplib.SMTPDataError)
+
+
+def get_recipient(answer):
+    """
+    Email of the entrant, taken from the anonymous user data when the
+    answer has no user.
+    """
+    if answer.user_id and answer.user.email:
+        return answer.user.email
+    data = answer.user_anony_data
+    if isinstance(data, dict):
+        return data.get('email')
+    return None
+
+
+class PlainText(object):
+    """
+    Stands for a body that does not compile, which is sent as is.
+    """
+
+    def __init__(self, source):
+        self.source = source
+
+    def render(self, context):
+        return self.source
+
+
+class EmailTemplateCache(object):
+    """
+    Admin edited email bodies compiled to Django templates once per promo
+    and date_update, instead of for every recipient. Kept per process;
+    saving the promo changes date_update and so recompiles them.
+    """
+
+    def __init__(self):
+        self._templates = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, promo, field):
+        """
+        Return the compiled ``field`` of ``promo``, or None when blank.
+        """
+        source = getattr(promo, field)
+        if not source:
+            return None
+
+        key = (promo.pk, field)
+        version = getattr(promo, 'date_update', None)
+        cached = self._templates.get(key)
+        if cached is not None and cached[0] == version and \
+                cached[1] == source:
+            self.hits += 1
+            return cached[2]
+
+        self.misses += 1
+        try:
+            template = Template(source)
+        except TemplateSyntaxError:
+            logger.exception(u"Invalid %s of promo %s", field, promo.pk)
+            template = PlainText(source)
+        with self._lock:
+            self._templates[key] = (version, source, template)
+        return template
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+email_templates = EmailTemplateCache()
+
+
+def get_email_context(promo, answer, promo_url):
+    """
+    Variables available to the email templates of a promo.
+    """
+    data = answer.user_anony_data if isinstance(answer.user_anony_data,
+                                                dict) else {}
+    user = answer.user if answer.user_id else None
+    if user is not None:
+        name = user.get_full_name() or user.get_username()
+    else:
+        name = data.get('name', u'')
+    return {
+        'promo': promo,
+        'promo_url': promo_url,
+        'answer': answer,
+        'answer_summary': Truncator(
+            answer.answer or answer.answer_url or
+            (answer.answer_file and answer.filename) or u'').chars(200),
+        'user': user,
+        'name': name,
+    }
+
+
+def get_promo_url(promo):
+    return u'http://{0}{1}'.format(promo.site.domain, promo.get_absolute_url())
+
+
+def render_body(template, context, default, autoescape=True):
+    if template is None:
+        return default
+    return template.render(Context(context, autoescape=autoescape))
+
+
+def build_confirmations(promo, answers):
+    """
+    Return the confirmation message of each answer, by answer id. The
+    promo's templates are compiled once and rendered per recipient.
+    """
+    subject = _(u"You are now registered for %s.") % promo.title
+    default_txt = _(
+        u"Thank you! "
+        u"You are now inscribed to {obj.title}"
+    ).format(obj=promo)
+    text_template = email_templates.get(promo, 'confirmation_email_txt')
+    html_template = email_templates.get(promo, 'confirmation_email_html')
+    from_email = promo.confirmation_email_address or \
+        settings.DEFAULT_FROM_EMAIL
+    promo_url = get_promo_url(promo)
+
+    messages = {}
+    for answer in answers:
+        recipient = get_recipient(answer)
+        if not recipient:
+            continue
+        context = get_email_context(promo, answer, promo_url)
+        msg = EmailMultiAlternatives(
+            subject,
+            render_body(text_template, context, default_txt,
+                        autoescape=False),
+            from_email, [recipient])
+        msg.attach_alternative(
+            render_body(html_template, context, default_txt), 'text/html')
+        messages[answer.pk] = msg
+    return messages
+
+
+def get_winner_templates(promo):
+    """
+    The winner email templates of a promo, looked up by its slug first:
+    ``promos/emails/<slug>/winner.txt`` then ``promos/emails/winner.txt``
+    (and .html).
+    """
+    return [select_template([
+        'promos/emails/{0}/winner.{1}'.format(promo.slug, extension),
+        'promos/emails/winner.{0}'.format(extension)
+    ]) for extension in ('txt', 'html')]
+
+
+def build_winner_notifications(promo, answers):
+    """
+    Return the winner notification of each answer, by answer id. The
+    templates are loaded once per batch and rendered per recipient.
+    """
+    subject = _(u"You are a winner of %s!") % promo.title
+    text_template, html_template = get_winner_templates(promo)
+    from_email = promo.confirmation_email_address or \
+        settings.DEFAULT_FROM_EMAIL
+    promo_url = get_promo_url(promo)
+
+    messages = {}
+    for answer in answers:
+        recipient = get_recipient(answer)
+        if not recipient:
+            continue
+        context = get_email_context(promo, answer, promo_url)
+        msg = EmailMultiAlternatives(
+            subject, text_template.render(Context(context, autoescape=False)),
+            from_email, [recipient])
+        msg.attach_alternative(html_template.render(Context(context)),
+                               'text/html')
+        messages[answer.pk] = msg
+    return messages
+
+
+BUILDERS = {
+    Outbox.KIND_CONFIRMATION: build_confirmations,
+    Outbox.KIND_WINNER: build_winner_notifications,
+}
+
+
+def queue_confirmations(answers):
+    """
+    Add the confirmations of saved answers whose promo sends them to the
+    outbox. Answers written with bulk_create may lack their id, which is
+    then looked up by receipt. Returns the new outbox entries.
+    """
+    answers = [a for a in answers if a.promo.send_confirmation_email]
+    missing = [a.receipt for a in answers if a.pk is None and a.receipt]
+    if missing:
+        ids = dict(Answer.objects.filter(receipt__in=missing).values_list(
+            'receipt', 'pk'))
+        for answer in answers:
+            answer.pk = answer.pk or ids.get(answer.receipt)
+    return Outbox.objects.enqueue(answers, Outbox.KIND_CONFIRMATION)
+
+
+def queue_winner_notifications(promo, chunk_size=1000):
+    """
+    Add a notification for every published winner of ``promo`` to the
+    outbox, streaming their ids in chunks. Winners notified or queued
+    before are skipped, so running it again only adds new winners.
+    Returns how many were queued.
+    """
+    ids = promo.winners.order_by('pk').values_list('pk', flat=True)
+    queued, chunk = 0, []
+    for pk in ids.iterator():
+        chunk.append(pk)
+        if len(chunk) == chunk_size:
+            queued += len(Outbox.objects.enqueue_ids(chunk,
+                                                     Outbox.KIND_WINNER))
+            chunk = []
+    if chunk:
+        queued += len(Outbox.objects.enqueue_ids(chunk, Outbox.KIND_WINNER))
+    return queued
+
+
+def get_progress(promo, kind):
+    """
+    Outbox entries of ``kind`` for ``promo`` per status.
+    """
+    progress = dict((status, 0) for status, name in Outbox.STATUS_CHOICES)
+    progress.update(Outbox.objects.filter(
+        answer__promo=promo, kind=kind).order_by().values_list(
+            'status').annotate(total=Count('pk')))
+    return progress
+
+
+def metric_key(name):
+    return make_key('outbox', 'metrics', name)
+
+
+def incr_metric(name, delta):
+    if not delta:
+        return
+    key = metric_key(name)
+    cache.add(key, 0, VERSION_TIMEOUT)
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        pass
+
+
+def outbox_stats():
+    """
+    Entries per status, plus the sent/failed counters and the average
+    latency between queueing and sending, for sizing mail workers.
+    """
+    stats = dict((status, 0) for status, name in Outbox.STATUS_CHOICES)
+    stats.update(Outbox.objects.order_by().values_list('status').annotate(
+        total=Count('pk')))
+
+    names = ['sent', 'failed', 'latency']
+    metrics = cache.get_many([metric_key(name) for name in names])
+    for name in names:
+        stats['{0}_total'.format(name)] = metrics.get(metric_key(name), 0)
+    latency = stats.pop('latency_total')
+    stats['average_latency'] = \
+        float(latency) / stats['sent_total'] if stats['sent_total'] else None
+    return stats
+
+
+class Throttle(object):
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next = time.time()
+
+    def wait(self):
+        if self.interval:
+            delay = self.next - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.next = max(self.next, time.time()) + self.interval
+
+
+def expire_claims(now=None):
+    """
+    Fail entries a dead worker left claimed; whether they were sent is
+    unknown, so they are not sent again automatically.
+    """
+    now = now or timezone.now()
+    return Outbox.objects.filter(
+        status=Outbox.STATUS_SENDING,
+        date_claimed__lt=now - timedelta(seconds=CLAIM_TIMEOUT)
+    ).update(status=Outbox.STATUS_FAILED, claim=None,
+             error=u"Interrupted while sending")
+
+
+def claim_entries(batch_size, **filters):
+    retry = timezone.now() - timedelta(seconds=RETRY_DELAY)
+    pending = Outbox.objects.filter(
+        Q(date_claimed__isnull=True) | Q(date_claimed__lt=retry),
+        status=Outbox.STATUS_PENDING, **filters)
+    ids = list(pending.order_by('pk').values_list('pk', flat=True)[
+        :batch_size])
+    if not ids:
+        return []
+
+    claim = uuid.uuid4().hex
+    # entries claimed meanwhile by another worker are not updated
+    pending.filter(pk__in=ids).update(status=Outbox.STATUS_SENDING,
+                                      claim=claim,
+                                      date_claimed=timezone.now())
+    return list(Outbox.objects.filter(claim=claim).select_related(
+        'answer', 'answer__user', 'answer__promo__site').order_by('pk'))
+
+
+def finish_entry(entry, error=None):
+    now = timezone.now()
+    if error is None:
+        Outbox.objects.filter(pk=entry.pk).update(
+            status=Outbox.STATUS_SENT, claim=None, date_sent=now,
+            attempts=entry.attempts + 1)
+        incr_metric('sent', 1)
+        incr_metric('latency', int(
+            (now - entry.date_insert).total_seconds()))
+        return
+
+    attempts = entry.attempts + 1
+    # a missing recipient will not show up by retrying
+    retry = attempts < EMAIL_MAX_ATTEMPTS and \
+        not isinstance(error, LookupError)
+    Outbox.objects.filter(pk=entry.pk).update(
+        status=Outbox.STATUS_PENDING if retry else Outbox.STATUS_FAILED,
+        claim=None, attempts=attempts, error=unicode(error))
+    if not retry:
+        incr_metric('failed', 1)
+
+
+def send_entries(entries, connection, throttle=None):
+    """
+    Send claimed entries over ``connection``, recording each outcome.
+    Entries whose messages fail to build count a failed attempt.
+    Connection errors release the unsent entries and are raised.
+    Returns how many were sent.
+    """
+    groups = collections.OrderedDict()
+    for entry in entries:
+        groups.setdefault((entry.kind, entry.answer.promo_id),
+                          []).append(entry)
+
+    sent = 0
+    remaining = list(entries)
+    try:
+        for (kind, promo_id), group in groups.items():
+            try:
+                messages = BUILDERS[kind](group[0].answer.promo,
+                                          [entry.answer for entry in group])
+            except Exception as exc:
+                logger.exception(u"Could not build the %s emails of promo %s",
+                                 kind, promo_id)
+                for entry in group:
+                    remaining.remove(entry)
+                    finish_entry(entry, exc)
+                continue
+            for entry in group:
+                message = messages.get(entry.answer_id)
+                if message is None:
+                    finish_entry(entry, LookupError(u"No recipient"))
+                    remaining.remove(entry)
+                    continue
+                if throttle:
+                    throttle.wait()
+                try:
+                    connection.send_messages([message])
+                except MESSAGE_ERRORS as exc:
+                    remaining.remove(entry)
+                    finish_entry(entry, exc)
+                else:
+                    # never released for sending again from here on
+                    remaining.remove(entry)
+                    finish_entry(entry)
+                    sent += 1
+    finally:
+        if remaining:
+            Outbox.objects.filter(pk__in=[e.pk for e in remaining]).update(
+                status=Outbox.STATUS_PENDING, claim=None, date_claimed=None)
+    return sent
+
+
+def deliver_outbox(batch_size=EMAIL_BATCH_SIZE, rate=EMAIL_RATE, limit=None,
+                   callback=None, **filters):
+    """
+    Send pending outbox entries over one connection until there are none
+    left, or ``limit`` were handled. ``filters`` narrow the entries, e.g.
+    ``kind`` or ``answer__promo``, and ``callback`` is called with the
+    sent count after each batch. Returns how many were sent.
+    """
+    expire_claims()
+
+    sent = handled = 0
+    throttle = Throttle(rate)
+    connection = get_connection()
+    # opened here so send_messages() keeps it for the whole run
+    connection.open()
+    try:
+        while limit is None or handled < limit:
+            size = batch_size if limit is None else \
+                min(batch_size, limit - handled)
+            entries = claim_entries(size, **filters)
+            if not entries:
+                break
+            sent += send_entries(entries, connection, throttle)
+            handled += len(entries)
+            if callback is not None:
+                callback(sent)
+    finally:
+        connection.close()
+    return sent
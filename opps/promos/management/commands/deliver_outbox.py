@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from opps.promos import mail
+
+
+class Command(BaseCommand):
+    help = u"Send the pending emails of the promo outbox"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=mail.EMAIL_BATCH_SIZE,
+                    help=u"Emails claimed at a time"),
+        make_option('--rate', type='float', dest='rate',
+                    default=mail.EMAIL_RATE,
+                    help=u"Max emails sent per second"),
+        make_option('--limit', type='int', dest='limit', default=None,
+                    help=u"Stop after handling this many emails"),
+        make_option('--stats', action='store_true', dest='stats',
+                    default=False,
+                    help=u"Only print the outbox counters"),
+    )
+
+    def handle(self, *args, **options):
+        if not options['stats']:
+            sent = mail.deliver_outbox(batch_size=options['batch_size'],
+                                       rate=options['rate'],
+                                       limit=options['limit'])
+            self.stdout.write(u"{0} email(s) sent".format(sent))
+
+        for name, value in sorted(mail.outbox_stats().items()):
+            self.stdout.write(u"{0}: {1}".format(name, value))
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from opps.promos.buffer import answer_buffer, HOLE_TIMEOUT
+
+
+class Command(BaseCommand):
+    help = u"Write every answer waiting in the write-behind buffer"
+
+    def handle(self, *args, **options):
+        if answer_buffer is None:
+            raise CommandError(u"OPPS_PROMOS_ANSWER_BUFFER is not enabled")
+
+        written = 0
+        deadline = time.time() + HOLE_TIMEOUT * 2
+        while len(answer_buffer) and time.time() < deadline:
+            written += len(answer_buffer.flush())
+            if len(answer_buffer):
+                # another flusher holds the lock or a writer is mid append
+                time.sleep(1)
+
+        self.stdout.write(u"{0} answer(s) written, {1} left".format(
+            written, len(answer_buffer)))
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from opps.promos import mail
+from opps.promos.models import Promo, Outbox
+
+
+class Command(BaseCommand):
+    args = u'<promo_id or slug>'
+    help = (u"Email the winners of a promo. Progress is kept in the outbox, "
+            u"so an interrupted run resumes without sending twice")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=mail.EMAIL_BATCH_SIZE,
+                    help=u"Emails sent per batch"),
+        make_option('--rate', type='float', dest='rate',
+                    default=mail.EMAIL_RATE,
+                    help=u"Max emails sent per second"),
+        make_option('--queue-only', action='store_true', dest='queue_only',
+                    default=False,
+                    help=u"Only queue, leaving delivery to the workers"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError(u"Give one promo id or slug")
+        lookup = {'pk': args[0]} if args[0].isdigit() else {'slug': args[0]}
+        try:
+            promo = Promo.objects.get(**lookup)
+        except Promo.DoesNotExist:
+            raise CommandError(u"Promo {0} does not exist".format(args[0]))
+
+        queued = mail.queue_winner_notifications(promo)
+        self.stdout.write(u"{0} winner(s) queued".format(queued))
+
+        if options['queue_only']:
+            return
+
+        def report(sent):
+            progress = mail.get_progress(promo, Outbox.KIND_WINNER)
+            self.stdout.write(u"{0} sent, {1} pending, {2} failed".format(
+                progress[Outbox.STATUS_SENT],
+                progress[Outbox.STATUS_PENDING],
+                progress[Outbox.STATUS_FAILED]))
+
+        mail.deliver_outbox(batch_size=options['batch_size'],
+                            rate=options['rate'], callback=report,
+                            kind=Outbox.KIND_WINNER, answer__promo=promo)
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from opps.promos.models import Promo
+
+
+class Command(BaseCommand):
+    args = u'[promo_id promo_id ...]'
+    help = u"Recompute the answer, published answer and winner counters"
+
+    def handle(self, *args, **options):
+        promo_ids = [int(pk) for pk in args] or None
+        fixed = Promo.objects.recount_answers(promo_ids)
+        self.stdout.write(u"{0} promo(s) updated".format(fixed))
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from opps.promos.models import Promo
+
+
+class Command(BaseCommand):
+    help = u"Open and close promos whose dates have crossed a boundary"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--watch', action='store_true', dest='watch',
+                    default=False,
+                    help=u"Keep running, waking up at each boundary"),
+        make_option('--interval', type='int', dest='interval', default=60,
+                    help=u"Max seconds to sleep between runs with --watch"),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            now = timezone.now()
+            for promo in Promo.objects.update_status(now):
+                self.stdout.write(u"{0}: {1}".format(promo.slug,
+                                                     promo.status))
+
+            if not options['watch']:
+                return
+
+            delay = options['interval']
+            next_change = Promo.objects.next_status_change(now)
+            if next_change:
+                seconds = (next_change - timezone.now()).total_seconds()
+                delay = max(0, min(delay, seconds))
+            time.sleep(delay)
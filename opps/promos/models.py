@@ -1,22 +1,34 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
 import os
 import uuid
 from importlib import import_module
 
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction, IntegrityError
+from django.db.models import Q, F, Min, Count
+from django.db.models.signals import (post_init, post_save, pre_delete,
+                                      post_delete, m2m_changed)
+from django.dispatch import receiver
+from django.core.cache import cache
+from django.core.files.storage import get_storage_class
 from django.utils import timezone
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from django.core.urlresolvers import reverse
-from django.forms.models import modelform_factory
 
 from opps.core.models import PublishableManager
 from opps.images.models import Image
 from opps.images.generate import image_url
 from opps.db.models.fields.jsonf import JSONField
 from opps.containers.models import Container
+from opps.channels.models import Channel
+
+from .cache import (make_key, get_version, bump_version, get_generation,
+                    bump_generation, bump_promo_version, CACHE_TIMEOUT)
+from .lookups import filter_objects, UnsupportedLookup
+from .signals import (promo_status_changed, promo_opened, promo_closed,
+                      answers_written)
 
 app_namespace = getattr(settings, 'OPPS_PROMOS_URL_NAMESPACE', 'promos')
 
@@ -26,21 +38,262 @@ ANONY_USER_FORM = getattr(
 
 class PromoManager(PublishableManager):
 
-    def all_opened(self):
-        return super(PromoManager, self).get_query_set().filter(
-            date_available__lte=timezone.now(),
-            published=True
-        ).filter(
-            Q(date_end__gte=timezone.now()) | Q(date_end__isnull=True)
-        )
+    def get_site_schedule(self, site):
+        """
+        Return the cached open/closed primary keys of a site. Entries are
+        keyed on the site generation, which is bumped on every promo save
+        and status transition.
+        """
+        site_id = getattr(site, 'pk', site)
+        key = make_key('schedule', site_id, get_generation(site_id))
+
+        schedule = cache.get(key)
+        if schedule is None:
+            schedule = {'opened': [], 'closed': []}
+            promos = super(PromoManager, self).get_query_set().filter(
+                site=site_id,
+                published=True,
+                status__in=(self.model.STATUS_OPEN, self.model.STATUS_CLOSED)
+            ).values_list('pk', 'status')
+            for pk, status in promos:
+                if status == self.model.STATUS_OPEN:
+                    schedule['opened'].append(pk)
+                else:
+                    schedule['closed'].append(pk)
+            cache.set(key, schedule, CACHE_TIMEOUT)
+
+        return schedule
+
+    def opened_ids(self, site):
+        """
+        Cached primary keys of the open promos of a site: no query while
+        the site generation holds. Use these on hot paths.
+        """
+        return self.get_site_schedule(site)['opened']
+
+    def closed_ids(self, site):
+        """
+        Cached primary keys of the closed promos of a site.
+        """
+        return self.get_site_schedule(site)['closed']
+
+    def all_opened(self, site=None):
+        """
+        Queryset of the published open promos, of ``site`` when given.
+        Evaluating it always queries the database; callers that only need
+        the set use opened_ids(), or get_site_promos() for the objects.
+        """
+        qs = super(PromoManager, self).get_query_set().filter(
+            published=True, status=self.model.STATUS_OPEN)
+        if site is not None:
+            qs = qs.filter(site=getattr(site, 'pk', site))
+        return qs
+
+    def all_closed(self, site=None):
+        """
+        Queryset of the published closed promos, of ``site`` when given.
+        Like all_opened(), see closed_ids() for the cached keys.
+        """
+        qs = super(PromoManager, self).get_query_set().filter(
+            published=True, status=self.model.STATUS_CLOSED)
+        if site is not None:
+            qs = qs.filter(site=getattr(site, 'pk', site))
+        return qs
+
+    def get_site_promos(self, site, opened=True):
+        """
+        Return the open (or closed) promos of a site as a list with their
+        banner, main_image and channel loaded, cached under the site
+        generation.
+        """
+        site_id = getattr(site, 'pk', site)
+        key = make_key('promos', site_id, 'opened' if opened else 'closed',
+                       get_generation(site_id))
+
+        promos = cache.get(key)
+        if promos is None:
+            ids = self.opened_ids(site_id) if opened else \
+                self.closed_ids(site_id)
+            promos = list(super(PromoManager, self).get_query_set().filter(
+                pk__in=ids).select_related('banner', 'main_image', 'channel'))
+            cache.set(key, promos, CACHE_TIMEOUT)
+
+        return promos
+
+    def get_promos_by(self, site, opened=True, exclude=False, **filters):
+        """
+        Return the open (or closed) promos of a site matching ``filters``
+        as a list, cached per filter set under the site generation.
+        Filters are applied in memory over get_site_promos(), so every
+        filter set shares a single query; lookups that cannot be
+        evaluated there are sent to the database.
+        """
+        site_id = getattr(site, 'pk', site)
+        normalize = lambda arg: getattr(arg, 'pk', arg)
+        normalized = repr(sorted(
+            (lookup, sorted(map(normalize, arg))
+             if isinstance(arg, (list, tuple, set)) else normalize(arg))
+            for lookup, arg in filters.items()))
+        key = make_key('promos_by', site_id, int(bool(opened)),
+                       int(bool(exclude)),
+                       hashlib.md5(normalized).hexdigest(),
+                       get_generation(site_id))
+
+        promos = cache.get(key)
+        if promos is None:
+            try:
+                promos = filter_objects(self.get_site_promos(site_id, opened),
+                                        filters, exclude)
+            except UnsupportedLookup:
+                qs = self.all_opened(site_id) if opened else \
+                    self.all_closed(site_id)
+                qs = qs.exclude(**filters) if exclude else qs.filter(**filters)
+                promos = list(qs.select_related('banner', 'main_image',
+                                                'channel'))
+            cache.set(key, promos, CACHE_TIMEOUT)
+
+        return promos
+
+    def get_visible_ids(self, site):
+        """
+        Return the cached open and closed primary keys of the promos
+        visible on a site, its own and mirrored ones, so list views can
+        page over ``pk__in`` instead of a DISTINCT over the mirror join.
+        """
+        site_id = getattr(site, 'pk', site)
+        key = make_key('visible', site_id, get_generation(site_id))
+
+        visible = cache.get(key)
+        if visible is None:
+            qs = super(PromoManager, self).get_query_set().filter(
+                published=True,
+                status__in=(self.model.STATUS_OPEN, self.model.STATUS_CLOSED)
+            )
+            # (promo, site) is unique in the mirror table, so neither query
+            # returns duplicates; the union drops the overlap
+            promos = set(qs.filter(site=site_id).values_list('pk', 'status'))
+            promos.update(qs.filter(mirror_site=site_id).values_list(
+                'pk', 'status'))
+            visible = {'opened': [], 'closed': []}
+            for pk, status in sorted(promos):
+                if status == self.model.STATUS_OPEN:
+                    visible['opened'].append(pk)
+                else:
+                    visible['closed'].append(pk)
+            cache.set(key, visible, CACHE_TIMEOUT)
+
+        return visible
+
+    def get_visible_id(self, slug, site, scheduled=False):
+        """
+        Return the pk of the published promo with ``slug`` visible on
+        ``site``, preferring promos of the site itself over mirrored ones
+        and then the latest date_available. With ``scheduled``, promos yet
+        to open are found too. Cached under the site generation, misses
+        included.
+        """
+        site_id = getattr(site, 'pk', site)
+        statuses = [self.model.STATUS_OPEN, self.model.STATUS_CLOSED]
+        if scheduled:
+            statuses.append(self.model.STATUS_SCHEDULED)
+        key = make_key('slug', site_id, slug, u','.join(statuses),
+                       get_generation(site_id))
 
-    def all_closed(self):
-        return super(PromoManager, self).get_query_set().filter(
-            date_available__lte=timezone.now(),
-            published=True,
-            date_end__lte=timezone.now()
+        pk = cache.get(key)
+        if pk is None:
+            promos = list(super(PromoManager, self).get_query_set().filter(
+                Q(site=site_id) | Q(mirror_site=site_id),
+                slug=slug,
+                published=True,
+                status__in=statuses
+            ).order_by('-date_available').values_list('pk', 'site'))
+            own = [p for p, promo_site in promos if promo_site == site_id]
+            pk = (own or [p for p, promo_site in promos] or [0])[0]
+            cache.set(key, pk, CACHE_TIMEOUT)
+
+        return pk or None
+
+    def update_status(self, now=None):
+        """
+        Move every promo whose dates have crossed a boundary to its new
+        status, firing promo_status_changed for each transition. Returns
+        the list of changed promos.
+        """
+        now = now or timezone.now()
+        available = Q(date_available__lte=now) | Q(date_available__isnull=True)
+        running = Q(date_end__gt=now) | Q(date_end__isnull=True)
+
+        # the same precedence as compute_status(), so a promo ending before
+        # it starts is not picked again on every run
+        promos = super(PromoManager, self).get_query_set().filter(
+            Q(date_available__gt=now) & ~Q(status=self.model.STATUS_SCHEDULED) |
+            available & running & ~Q(status=self.model.STATUS_OPEN) |
+            available & Q(date_end__lte=now) &
+            ~Q(status=self.model.STATUS_CLOSED)
         )
 
+        changed = []
+        for promo in promos:
+            old_status = promo.status
+            promo.status = promo.compute_status(now)
+            if promo.status == old_status:
+                continue
+            # conditional update so concurrent schedulers fire only once
+            updated = self.filter(pk=promo.pk, status=old_status).update(
+                status=promo.status)
+            if updated:
+                changed.append(promo)
+                promo.send_status_signals(old_status)
+        return changed
+
+    def next_status_change(self, now=None):
+        """
+        Return the next instant at which a promo changes status, if any.
+        """
+        now = now or timezone.now()
+        qs = super(PromoManager, self).get_query_set()
+        boundaries = [
+            qs.filter(status=self.model.STATUS_SCHEDULED,
+                      date_available__gt=now).aggregate(
+                          next=Min('date_available'))['next'],
+            qs.exclude(status=self.model.STATUS_CLOSED).filter(
+                date_end__gt=now).aggregate(next=Min('date_end'))['next'],
+        ]
+        boundaries = [b for b in boundaries if b is not None]
+        return min(boundaries) if boundaries else None
+
+    def recount_answers(self, promo_ids=None):
+        """
+        Recompute the denormalized answer counters from the answer table,
+        writing only the promos that drifted. Returns how many were fixed.
+        """
+        answers = Answer.objects.order_by()
+        promos = super(PromoManager, self).get_query_set()
+        if promo_ids is not None:
+            answers = answers.filter(promo__in=promo_ids)
+            promos = promos.filter(pk__in=promo_ids)
+
+        def count(qs):
+            return dict(qs.values_list('promo').annotate(total=Count('pk')))
+
+        totals = count(answers)
+        published = count(answers.filter(published=True))
+        winners = count(answers.filter(published=True, is_winner=True))
+
+        fixed = 0
+        for pk, answer_count, published_answer_count, winner_count in \
+                promos.values_list('pk', 'answer_count',
+                                   'published_answer_count', 'winner_count'):
+            counters = dict(answer_count=totals.get(pk, 0),
+                            published_answer_count=published.get(pk, 0),
+                            winner_count=winners.get(pk, 0))
+            if counters != dict(answer_count=answer_count,
+                                published_answer_count=published_answer_count,
+                                winner_count=winner_count):
+                self.filter(pk=pk).update(**counters)
+                fixed += 1
+        return fixed
+
 
 class Promo(Container):
 
@@ -56,6 +309,16 @@ class Promo(Container):
         ("text|url|upload", _(u"Text, Url and Upload")),
     )
 
+    STATUS_SCHEDULED = 'scheduled'
+    STATUS_OPEN = 'open'
+    STATUS_CLOSED = 'closed'
+
+    STATUS_CHOICES = (
+        (STATUS_SCHEDULED, _(u"Scheduled")),
+        (STATUS_OPEN, _(u"Open")),
+        (STATUS_CLOSED, _(u"Closed")),
+    )
+
     headline = models.TextField(_(u"Headline"), blank=True)
     description = models.TextField(_(u"Description"), blank=True)
 
@@ -113,6 +376,35 @@ class Promo(Container):
         default=True
     )
 
+    # parsed by ratelimit.parse_limits, on top of OPPS_PROMOS_RATE_LIMITS
+    rate_limits = models.CharField(
+        _(u"Rate limits"),
+        max_length=100,
+        blank=True,
+        help_text=_(u"Submission limits overriding the settings, e.g. "
+                    u"ip=10/m user=5/m promo=500/s")
+    )
+
+    status = models.CharField(
+        _(u"Status"),
+        max_length=10,
+        choices=STATUS_CHOICES,
+        default=STATUS_SCHEDULED,
+        db_index=True,
+        editable=False
+    )
+
+    # maintained by the Answer signal handlers, see recount_answers()
+    COUNTER_FIELDS = ('answer_count', 'published_answer_count',
+                      'winner_count')
+
+    answer_count = models.IntegerField(
+        _(u"Answers"), default=0, editable=False)
+    published_answer_count = models.IntegerField(
+        _(u"Published answers"), default=0, editable=False)
+    winner_count = models.IntegerField(
+        _(u"Winners"), default=0, editable=False)
+
     @property
     def countdown(self):
         if self.date_end and self.countdown_enabled:
@@ -127,23 +419,12 @@ class Promo(Container):
             return [self.form_type]
 
     def get_anony_user_form(self):
-        mod, cls_name = ANONY_USER_FORM.rsplit('.', 1)
-        return getattr(import_module(mod), cls_name)
-
+        from .forms import form_registry
+        return form_registry.get_anony_user_form()
 
     def get_answer_form(self):
-        from .forms import BaseAnswerForm
-
-        fields = []
-
-        if self.has_textfield:
-            fields.append('answer')
-        if self.has_urlfield:
-            fields.append('answer_url')
-        if self.has_upload:
-            fields.append('answer_file')
-
-        return modelform_factory(Answer, form=BaseAnswerForm, fields=fields)
+        from .forms import form_registry
+        return form_registry.get_answer_form(self.form_type)
 
     @property
     def has_upload(self):
@@ -159,13 +440,49 @@ class Promo(Container):
 
     @property
     def is_opened(self):
-        now = timezone.now()
-        self.date_available = self.date_available or now
-        if not self.date_end and self.date_available <= now:
-            return True
-        elif not self.date_end and self.date_available > now:
-            return False
-        return now >= self.date_available and now <= self.date_end
+        return self.status == self.STATUS_OPEN
+
+    def compute_status(self, now=None):
+        now = now or timezone.now()
+        if self.date_available and self.date_available > now:
+            return self.STATUS_SCHEDULED
+        if self.date_end and self.date_end <= now:
+            return self.STATUS_CLOSED
+        return self.STATUS_OPEN
+
+    def next_status_change(self, now=None):
+        """
+        Return the next instant at which this promo changes status, if any.
+        """
+        now = now or timezone.now()
+        if self.date_available and self.date_available > now:
+            return self.date_available
+        if self.date_end and self.date_end > now:
+            return self.date_end
+        return None
+
+    def send_status_signals(self, old_status):
+        promo_status_changed.send(sender=self.__class__, instance=self,
+                                  old_status=old_status, status=self.status)
+        if self.status == self.STATUS_OPEN:
+            promo_opened.send(sender=self.__class__, instance=self)
+        elif self.status == self.STATUS_CLOSED:
+            promo_closed.send(sender=self.__class__, instance=self)
+
+    def save(self, *args, **kwargs):
+        old_status = self.status
+        self.status = self.compute_status()
+        if not self._state.adding and not kwargs.get('force_insert') and \
+                kwargs.get('update_fields') is None:
+            # the counters only move through F() updates, which an instance
+            # loaded before them would overwrite
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.fields
+                if not field.primary_key and
+                field.name not in self.COUNTER_FIELDS]
+        super(Promo, self).save(*args, **kwargs)
+        if old_status != self.status:
+            self.send_status_signals(old_status)
 
     @property
     def answers(self):
@@ -175,12 +492,32 @@ class Promo(Container):
     def winners(self):
         return self.answers.filter(is_winner=True)
 
+    @property
+    def answers_for_display(self):
+        return Answer.objects.for_display().filter(promo=self.pk,
+                                                   published=True)
+
+    @property
+    def winners_for_display(self):
+        return self.answers_for_display.filter(is_winner=True)
+
     def has_answered(self, user):
-        try:
-            return self.answers.filter(user=user).exists()
-        except TypeError:
+        """
+        Whether ``user`` already sent an answer, published or not. Answers
+        fill the participation cache on insert, so repeat visitors are
+        answered from the cache.
+        """
+        if user is None or not user.is_authenticated():
             return False
 
+        key = participation_cache_key(self.pk, user.pk)
+        answered = cache.get(key)
+        if answered is None:
+            answered = self.answer_set.filter(user=user).exists()
+            # add() so a concurrent insert is never overwritten with False
+            cache.add(key, answered, CACHE_TIMEOUT)
+        return answered
+
     def __unicode__(self):
         return self.title
 
@@ -188,6 +525,9 @@ class Promo(Container):
 
     class Meta:
         ordering = ['order']
+        index_together = [
+            ('status', 'order'),
+        ]
         verbose_name = _(u'Promo')
         verbose_name_plural = _(u'Promos')
 
@@ -205,6 +545,104 @@ class Promo(Container):
         return _("Promo")
 
 
+def promo_site_ids(promo):
+    site_ids = set([promo.site_id])
+    if promo.pk:
+        site_ids.update(promo.mirror_site.values_list('pk', flat=True))
+    return site_ids
+
+
+@receiver(post_save, sender=Promo)
+def promo_saved(sender, instance, **kwargs):
+    bump_generation(*promo_site_ids(instance))
+    bump_version('ratelimits')
+
+    from .tasks import schedule_status_update
+    schedule_status_update(instance)
+
+
+@receiver(pre_delete, sender=Promo)
+def promo_deleting(sender, instance, **kwargs):
+    # mirror sites are gone by the time post_delete fires
+    instance._site_ids = promo_site_ids(instance)
+
+
+@receiver(post_delete, sender=Promo)
+def promo_deleted(sender, instance, **kwargs):
+    bump_generation(*getattr(instance, '_site_ids', [instance.site_id]))
+    bump_version('ratelimits')
+
+
+@receiver(promo_status_changed, sender=Promo)
+def promo_status_updated(sender, instance, **kwargs):
+    # update_status() bypasses save(), so post_save never sees it
+    bump_generation(*promo_site_ids(instance))
+
+
+@receiver(m2m_changed, sender=Promo.mirror_site.through)
+def promo_mirror_site_changed(sender, instance, action, reverse, pk_set,
+                              **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        bump_generation(instance.pk)
+    elif isinstance(instance, Promo):
+        bump_generation(*promo_site_ids(instance).union(pk_set or []))
+
+
+def get_channel(long_slug, site=None):
+    """
+    Return the channel under ``long_slug`` (on ``site`` when given), or
+    None. Cached, misses included, until a channel is saved or deleted.
+    """
+    site_id = getattr(site, 'pk', site)
+    key = make_key('channel', site_id, long_slug, get_version('channels'))
+
+    channel = cache.get(key)
+    if channel is None:
+        channels = Channel.objects.filter(long_slug=long_slug)
+        if site_id is not None:
+            channels = channels.filter(site=site_id)
+        try:
+            channel = channels.get()
+        except Channel.DoesNotExist:
+            channel = 0
+        cache.set(key, channel, CACHE_TIMEOUT)
+
+    return channel or None
+
+
+def bump_promo_generations(**filters):
+    """
+    Bump the generation of every site showing a promo matching
+    ``filters``, directly or as a mirror.
+    """
+    site_ids = set()
+    for site_id, mirror_id in Promo.objects.filter(**filters).values_list(
+            'site', 'mirror_site'):
+        site_ids.update([site_id, mirror_id])
+    site_ids.discard(None)
+    bump_generation(*site_ids)
+
+
+@receiver(post_save, sender=Channel)
+@receiver(post_delete, sender=Channel)
+def channel_changed(sender, instance, **kwargs):
+    bump_version('channels')
+    # the cached promo lists carry their channel
+    bump_promo_generations(channel=instance.pk)
+
+
+@receiver(post_save, sender=Image)
+@receiver(pre_delete, sender=Image)
+def image_changed(sender, instance, **kwargs):
+    # the cached promo lists carry their banner and main image; on delete
+    # the promos lose them without signals, so bump beforehand
+    bump_promo_generations(
+        pk__in=Promo.objects.filter(
+            Q(main_image=instance.pk) | Q(banner=instance.pk)).values('pk'))
+
+
 class PromoContainer(models.Model):
     container = models.ForeignKey(
         'containers.Container',
@@ -240,6 +678,21 @@ def get_file_path(instance, filename):
     return os.path.join(folder, filename)
 
 
+class AnswerManager(models.Manager):
+
+    DISPLAY_FIELDS = ('id', 'promo', 'user', 'answer', 'answer_url',
+                      'answer_file', 'publish_file', 'published',
+                      'is_winner', 'date_insert')
+
+    def for_display(self):
+        """
+        Answers as listed by the templates: users joined in and only the
+        columns they render, leaving user_anony_data out.
+        """
+        return self.get_query_set().select_related('user').only(
+            *self.DISPLAY_FIELDS)
+
+
 class Answer(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              verbose_name=_(u'User'),
@@ -257,12 +710,33 @@ class Answer(models.Model):
         help_text=_(u'Show image thumbnail if image, or link if another type of file')
     )
     published = models.BooleanField(_(u"Published"), default=True)
-    date_insert = models.DateTimeField(_(u"Date insert"), auto_now_add=True)
+    # a default rather than auto_now_add, so buffered answers keep the
+    # time they were accepted when written later with bulk_create
+    date_insert = models.DateTimeField(_(u"Date insert"), default=timezone.now,
+                                       editable=False, blank=True)
     date_update = models.DateTimeField(_(u"Date update"), auto_now=True)
     is_winner = models.BooleanField(_(u"Is winner?"), default=False)
+    # "<promo_id>:<user_id>" for login required promos, enforcing one
+    # answer per user at the database level
+    participation_key = models.CharField(max_length=64, unique=True,
+                                         null=True, blank=True,
+                                         editable=False)
+    # identifies answers accepted through the write-behind buffer
+    receipt = models.CharField(max_length=32, unique=True, null=True,
+                               blank=True, editable=False)
+
+    objects = AnswerManager()
 
     class Meta:
         ordering = ['-date_insert']
+        index_together = [
+            # answers
+            ('promo', 'published', 'date_insert'),
+            # winners
+            ('promo', 'published', 'is_winner', 'date_insert'),
+            # has_answered
+            ('promo', 'user', 'published'),
+        ]
         verbose_name = _(u'Answer')
         verbose_name_plural = _(u'Answers')
 
@@ -270,6 +744,16 @@ class Answer(models.Model):
     def filename(self):
         return os.path.basename(self.answer_file.name)
 
+    def set_participation_key(self):
+        if self.user_id and self.promo.login_required:
+            self.participation_key = u"{0}:{1}".format(self.promo_id,
+                                                       self.user_id)
+
+    def save(self, *args, **kwargs):
+        if not self.participation_key:
+            self.set_participation_key()
+        super(Answer, self).save(*args, **kwargs)
+
     def __unicode__(self):
         return u"{0}-{1}".format(self.promo.slug, self.answer)
 
@@ -310,4 +794,241 @@ class Answer(models.Model):
         if form.is_valid():
             return [(f.label, f.value) for f in form.visible_fields()]
 
-        return data.items()
\ No newline at end of file
+        return data.items()
+
+
+class OutboxManager(models.Manager):
+
+    def enqueue(self, answers, kind):
+        """
+        Queue one ``kind`` email per saved answer, skipping answers that
+        already have one. Meant to run in the transaction that wrote the
+        answers. Returns the new entries.
+        """
+        return self.enqueue_ids([answer.pk for answer in answers
+                                 if answer.pk], kind)
+
+    def enqueue_ids(self, ids, kind):
+        queued = set(self.filter(answer__in=ids, kind=kind).values_list(
+            'answer', flat=True))
+        entries = [self.model(answer_id=pk, kind=kind)
+                   for pk in ids if pk not in queued]
+        if entries:
+            sid = transaction.savepoint()
+            try:
+                self.bulk_create(entries)
+            except IntegrityError:
+                # queued concurrently, the unique key keeps a single one
+                transaction.savepoint_rollback(sid)
+                entries = [e for e in entries if _insert_entry(e)]
+            else:
+                transaction.savepoint_commit(sid)
+        return entries
+
+
+def _insert_entry(entry):
+    sid = transaction.savepoint()
+    try:
+        entry.save()
+    except IntegrityError:
+        transaction.savepoint_rollback(sid)
+        return False
+    transaction.savepoint_commit(sid)
+    return True
+
+
+class Outbox(models.Model):
+    """
+    Emails due to entrants, written with the answers they are about and
+    delivered by mail.deliver_outbox. The (answer, kind) unique key makes
+    each answer get at most one email of each kind.
+    """
+
+    KIND_CONFIRMATION = 'confirmation'
+    KIND_WINNER = 'winner'
+
+    KIND_CHOICES = (
+        (KIND_CONFIRMATION, _(u"Confirmation")),
+        (KIND_WINNER, _(u"Winner notification")),
+    )
+
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (STATUS_PENDING, _(u"Pending")),
+        (STATUS_SENDING, _(u"Sending")),
+        (STATUS_SENT, _(u"Sent")),
+        (STATUS_FAILED, _(u"Failed")),
+    )
+
+    answer = models.ForeignKey(Answer, verbose_name=_(u'Answer'),
+                               related_name='outbox')
+    kind = models.CharField(_(u"Kind"), max_length=20, choices=KIND_CHOICES)
+    status = models.CharField(_(u"Status"), max_length=10,
+                              choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.IntegerField(_(u"Attempts"), default=0)
+    error = models.TextField(_(u"Last error"), blank=True)
+    # identifies the worker sending the entry
+    claim = models.CharField(max_length=32, null=True, blank=True,
+                             db_index=True, editable=False)
+    date_insert = models.DateTimeField(_(u"Date insert"), auto_now_add=True)
+    date_claimed = models.DateTimeField(_(u"Date claimed"), null=True,
+                                        blank=True)
+    date_sent = models.DateTimeField(_(u"Date sent"), null=True, blank=True)
+
+    objects = OutboxManager()
+
+    class Meta:
+        unique_together = [('answer', 'kind')]
+        index_together = [('status', 'id')]
+        verbose_name = _(u'Outbox email')
+        verbose_name_plural = _(u'Outbox')
+
+    def __unicode__(self):
+        return u"{0}-{1}".format(self.kind, self.answer_id)
+
+
+# exports hold entrant emails: point this at a private storage when the
+# default one serves MEDIA publicly
+export_storage = get_storage_class(
+    getattr(settings, 'OPPS_PROMOS_EXPORT_STORAGE', None))()
+
+
+class ExportJob(models.Model):
+    """
+    Background CSV export of answers, of one promo or all of them, run by
+    tasks.run_export_job into a gzip file in ``export_storage``, under a
+    random name and downloaded through the admin.
+    """
+
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (STATUS_PENDING, _(u"Pending")),
+        (STATUS_RUNNING, _(u"Running")),
+        (STATUS_DONE, _(u"Done")),
+        (STATUS_FAILED, _(u"Failed")),
+    )
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             verbose_name=_(u'User'),
+                             null=True, blank=True, editable=False)
+    promo = models.ForeignKey(Promo, verbose_name=_(u'Promo'),
+                              null=True, blank=True,
+                              help_text=_(u'Leave empty to export the '
+                                          u'answers of every promo'))
+    status = models.CharField(_(u"Status"), max_length=10,
+                              choices=STATUS_CHOICES, default=STATUS_PENDING,
+                              editable=False)
+    ranges = models.IntegerField(_(u"Id ranges"), default=0, editable=False)
+    ranges_done = models.IntegerField(_(u"Id ranges done"), default=0,
+                                      editable=False)
+    file = models.FileField(_(u"File"), upload_to='promos/exports',
+                            storage=export_storage, max_length=255,
+                            blank=True, editable=False)
+    error = models.TextField(_(u"Error"), blank=True, editable=False)
+    date_insert = models.DateTimeField(_(u"Date insert"), auto_now_add=True)
+    date_finished = models.DateTimeField(_(u"Date finished"), null=True,
+                                         blank=True, editable=False)
+
+    class Meta:
+        ordering = ['-date_insert']
+        verbose_name = _(u'Answer export')
+        verbose_name_plural = _(u'Answer exports')
+
+    def __unicode__(self):
+        return u"{0} {1}".format(self.promo or _(u'All promos'),
+                                 self.date_insert)
+
+    @property
+    def progress(self):
+        if self.status == self.STATUS_DONE:
+            return 100
+        if not self.ranges:
+            return 0
+        return 100 * self.ranges_done // self.ranges
+
+
+def participation_cache_key(promo_id, user_id):
+    return make_key('answered', promo_id, user_id)
+
+
+def answer_counter_state(answer):
+    return (answer.promo_id, answer.published,
+            answer.published and answer.is_winner)
+
+
+def displayed_promo_ids(*changes):
+    """
+    Promos whose pages list one of the answers in ``(old_state, new_state)``
+    changes, i.e. where the answer is or was published.
+    """
+    return [state[0] for change in changes for state in change
+            if state is not None and state[1]]
+
+
+def update_answer_counters(*changes):
+    """
+    Apply the counter difference of ``(old_state, new_state)`` answer
+    changes with atomic F() updates, one per promo. A state is None when
+    the answer does not exist.
+    """
+    deltas = {}
+    for old_state, new_state in changes:
+        for state, sign in ((old_state, -1), (new_state, 1)):
+            if state is None:
+                continue
+            promo_id, published, is_winner = state
+            counters = deltas.setdefault(promo_id, {})
+            for field, counted in (('answer_count', True),
+                                   ('published_answer_count', published),
+                                   ('winner_count', is_winner)):
+                if counted:
+                    counters[field] = counters.get(field, 0) + sign
+
+    for promo_id, counters in deltas.items():
+        updates = dict((field, F(field) + delta)
+                       for field, delta in counters.items() if delta)
+        if updates:
+            Promo.objects.filter(pk=promo_id).update(**updates)
+
+
+@receiver(post_init, sender=Answer)
+def answer_loaded(sender, instance, **kwargs):
+    instance._counter_state = instance.pk and answer_counter_state(instance)
+
+
+@receiver(post_save, sender=Answer)
+def answer_saved(sender, instance, created, **kwargs):
+    old_state = None if created else instance._counter_state
+    new_state = answer_counter_state(instance)
+    if old_state != new_state:
+        update_answer_counters((old_state, new_state))
+    instance._counter_state = new_state
+    bump_promo_version(*displayed_promo_ids((old_state, new_state)))
+
+    if created and instance.user_id:
+        cache.set(participation_cache_key(instance.promo_id, instance.user_id),
+                  True, CACHE_TIMEOUT)
+
+
+@receiver(post_delete, sender=Answer)
+def answer_deleted(sender, instance, **kwargs):
+    update_answer_counters((instance._counter_state, None))
+    bump_promo_version(*displayed_promo_ids((instance._counter_state, None)))
+
+    if instance.user_id:
+        cache.delete(participation_cache_key(instance.promo_id,
+                                             instance.user_id))
+
+
+@receiver(answers_written, sender=Answer)
+def answers_written_confirmations(sender, answers, **kwargs):
+    from .tasks import queue_confirmation_emails
+    queue_confirmation_emails(answers)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import base64
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class KeysetPage(object):
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+class KeysetPaginator(object):
+    """
+    Seek pagination over ``(date_insert, id)``, newest first. Each page is
+    one indexed range query whatever its depth, and nothing is counted.
+    Cursors are opaque tokens carrying the direction and the boundary row.
+    """
+
+    NEXT = 'n'
+    PREVIOUS = 'p'
+
+    def __init__(self, queryset, per_page=20):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+
+    def encode_cursor(self, direction, obj):
+        value = u'{0}|{1}|{2}'.format(direction, obj.date_insert.isoformat(),
+                                      obj.pk)
+        return base64.urlsafe_b64encode(value.encode('utf-8')).rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            value = base64.urlsafe_b64decode(
+                str(cursor) + '=' * (-len(cursor) % 4)).decode('utf-8')
+            direction, date_insert, pk = value.split(u'|')
+            date_insert = parse_datetime(date_insert)
+            pk = int(pk)
+        except (TypeError, ValueError, UnicodeError):
+            raise InvalidCursor(cursor)
+        if direction not in (self.NEXT, self.PREVIOUS) or date_insert is None:
+            raise InvalidCursor(cursor)
+        return direction, date_insert, pk
+
+    def page(self, cursor=None):
+        queryset = self.queryset
+        direction = self.NEXT
+
+        if cursor:
+            direction, date_insert, pk = self.decode_cursor(cursor)
+            if direction == self.NEXT:
+                queryset = queryset.filter(
+                    Q(date_insert__lt=date_insert) |
+                    Q(date_insert=date_insert, pk__lt=pk))
+            else:
+                queryset = queryset.filter(
+                    Q(date_insert__gt=date_insert) |
+                    Q(date_insert=date_insert, pk__gt=pk))
+
+        if direction == self.NEXT:
+            queryset = queryset.order_by('-date_insert', '-pk')
+        else:
+            queryset = queryset.order_by('date_insert', 'pk')
+
+        # one extra row tells whether there is more in this direction
+        object_list = list(queryset[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+
+        if direction == self.NEXT:
+            has_next, has_previous = has_more, bool(cursor)
+        else:
+            object_list.reverse()
+            has_next, has_previous = True, has_more
+
+        if not object_list:
+            return KeysetPage(object_list)
+
+        return KeysetPage(
+            object_list,
+            next_cursor=has_next and self.encode_cursor(
+                self.NEXT, object_list[-1]) or None,
+            previous_cursor=has_previous and self.encode_cursor(
+                self.PREVIOUS, object_list[0]) or None)
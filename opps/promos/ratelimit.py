@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Fixed window admission control for answer submissions.
+
+Nothing is limited by default. Limits are read from
+``OPPS_PROMOS_RATE_LIMITS``, a dict of per promo slug overrides on top of
+a ``'default'`` entry, each mapping a scope to a rate::
+
+    OPPS_PROMOS_RATE_LIMITS = {
+        'default': {'ip': '10/m', 'user': '5/m', 'promo': '500/s'},
+        'tv-promo': {'promo': '2000/s'},
+    }
+
+and then from the ``rate_limits`` field of the promo, written as
+``ip=10/m user=5/m promo=500/s``. ``ip`` and ``user`` buckets are per
+client and promo, ``promo`` is shared by everyone posting to that promo.
+A scope set to None (``none`` in the promo field) is not limited.
+
+Hits are counted per window of the rate's period with cache.add() and
+cache.incr(), atomic on memcached and redis, so concurrent submissions do
+not overshoot a window; around a window boundary up to twice the rate
+gets through.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+
+from .cache import make_key, get_version, CACHE_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RATE_LIMITS = {'ip': None, 'user': None, 'promo': None}
+RATE_LIMITS = getattr(settings, 'OPPS_PROMOS_RATE_LIMITS', {})
+IP_HEADER = getattr(settings, 'OPPS_PROMOS_RATE_LIMIT_IP_HEADER',
+                    'REMOTE_ADDR')
+# proxies appending to IP_HEADER: the client is the address the outermost
+# of them appended, anything left of it is sent by the client itself
+PROXY_COUNT = getattr(settings, 'OPPS_PROMOS_RATE_LIMIT_PROXY_COUNT', 1)
+
+PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+
+def parse_rate(rate):
+    """
+    Parse ``"<count>/<s|m|h|d>"`` into ``(capacity, period_seconds)``.
+    """
+    count, period = rate.split('/')
+    return int(count), PERIODS[period]
+
+
+def parse_limits(value):
+    """
+    Parse the ``rate_limits`` of a promo, e.g. ``"ip=10/m promo=none"``,
+    into a scope to rate dict. Raises ValueError when malformed.
+    """
+    limits = {}
+    for item in value.split():
+        scope, _sep, rate = item.partition('=')
+        if scope not in DEFAULT_RATE_LIMITS or not rate:
+            raise ValueError(u"Invalid rate limit: {0}".format(item))
+        if rate.lower() == 'none':
+            rate = None
+        else:
+            try:
+                parse_rate(rate)
+            except (KeyError, ValueError):
+                raise ValueError(u"Invalid rate: {0}".format(rate))
+        limits[scope] = rate
+    return limits
+
+
+def get_client_ip(request, header=IP_HEADER, proxies=PROXY_COUNT):
+    addresses = [address.strip()
+                 for address in request.META.get(header, '').split(',')
+                 if address.strip()]
+    if not addresses:
+        return ''
+    return addresses[-min(max(proxies, 1), len(addresses))]
+
+
+def get_promo_limits():
+    """
+    Return ``{promo pk: limits}`` for the promos with their own rate
+    limits, cached until a promo is saved or deleted.
+    """
+    from .models import Promo
+    key = make_key('ratelimits', get_version('ratelimits'))
+    limits = cache.get(key)
+    if limits is None:
+        limits = {}
+        for pk, value in Promo.objects.exclude(
+                rate_limits='').values_list('pk', 'rate_limits'):
+            try:
+                limits[pk] = parse_limits(value)
+            except ValueError:
+                logger.warning(u"Ignoring the rate limits of promo %s", pk)
+        cache.set(key, limits, CACHE_TIMEOUT)
+    return limits
+
+
+class MemoryStore(object):
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def incr(self, key, timeout):
+        with self._lock:
+            now = time.time()
+            value = self._data.get(key)
+            if value is None or value[1] < now:
+                if len(self._data) >= self.max_size:
+                    for stale in [k for k, v in self._data.items()
+                                  if v[1] < now]:
+                        del self._data[stale]
+                    if len(self._data) >= self.max_size:
+                        self._data.clear()
+                value = (0, now + timeout)
+            value = (value[0] + 1, value[1])
+            self._data[key] = value
+            return value[0]
+
+
+class RateLimiter(object):
+
+    def __init__(self):
+        self.memory = MemoryStore()
+        self.use_memory = isinstance(cache, DummyCache)
+        self.rejected = {}
+
+    def get_limits(self, slug, promo_id=None):
+        limits = dict(DEFAULT_RATE_LIMITS)
+        limits.update(RATE_LIMITS.get('default', {}))
+        limits.update(RATE_LIMITS.get(slug, {}))
+        limits.update(get_promo_limits().get(promo_id, {}))
+        return limits
+
+    def get_target(self, slug, site=None):
+        """
+        Return the pk of the promo ``slug`` resolves to on ``site`` (the
+        current one by default), or None, and the key parts of its
+        buckets: its pk, or the site and slug when there is no such promo,
+        so promos sharing a slug across sites never share a bucket.
+        """
+        from .models import Promo
+        site_id = getattr(site, 'pk', site) or settings.SITE_ID
+        promo_id = Promo.objects.get_visible_id(slug, site_id)
+        if promo_id:
+            return promo_id, ('promo', promo_id)
+        return None, ('slug', site_id, slug)
+
+    def incr(self, key, timeout):
+        if not self.use_memory:
+            try:
+                cache.add(key, 0, timeout)
+                return cache.incr(key)
+            except ValueError:
+                # expired between add() and incr()
+                cache.add(key, 1, timeout)
+                return 1
+            except Exception:
+                logger.exception(u"Rate limit cache unavailable")
+        return self.memory.incr(key, timeout)
+
+    def consume(self, key, rate):
+        """
+        Count a hit against the current window of the bucket under
+        ``key``, returning whether it is within ``rate``.
+        """
+        capacity, period = parse_rate(rate)
+        window = int(time.time() // period)
+        return self.incr(u'{0}:{1}'.format(key, window), period) <= capacity
+
+    def get_buckets(self, request, slug):
+        buckets = [('ip', get_client_ip(request))]
+        # read from the session so the user table is never queried
+        user_id = request.session.get(SESSION_KEY) \
+            if hasattr(request, 'session') else None
+        if user_id:
+            buckets.append(('user', user_id))
+        buckets.append(('promo', ''))
+        return buckets
+
+    def allow(self, request, slug, site=None):
+        """
+        Whether a submission to the promo ``slug`` of ``site`` is admitted.
+        Client buckets go first so rejected clients do not drain the promo
+        one.
+        """
+        promo_id, target = self.get_target(slug, site)
+        limits = self.get_limits(slug, promo_id)
+        for scope, client in self.get_buckets(request, slug):
+            rate = limits.get(scope)
+            if not rate:
+                continue
+            parts = ('ratelimit', scope) + target + (unicode(client).strip(),)
+            if not self.consume(make_key(*parts), rate):
+                self.reject(target, scope)
+                return False
+        return True
+
+    def reject(self, target, scope):
+        self.rejected[scope] = self.rejected.get(scope, 0) + 1
+        key = make_key('ratelimit', 'rejected', *target)
+        try:
+            cache.add(key, 0)
+            cache.incr(key)
+        except Exception:
+            # counters are best effort, never fail a rejection on them
+            pass
+
+    def get_rejections(self, slug, site=None):
+        """
+        Rejections of the promo ``slug`` of ``site`` across processes, as
+        counted in the cache.
+        """
+        target = self.get_target(slug, site)[1]
+        return cache.get(make_key('ratelimit', 'rejected', *target)) or 0
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+from django.dispatch import Signal
+
+promo_status_changed = Signal(providing_args=['instance', 'old_status',
+                                              'status'])
+promo_opened = Signal(providing_args=['instance'])
+promo_closed = Signal(providing_args=['instance'])
+# sent by buffer.write_answers, which inserts with bulk_create
+answers_written = Signal(providing_args=['answers'])
@@ -1,28 +1,184 @@
+import logging
+import smtplib
+import socket
+
 import celery
 from django.conf import settings
-from django.utils.translation import ugettext_lazy as _
-from django.core.mail import EmailMultiAlternatives
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.utils import timezone
+
+from .buffer import answer_buffer, write_answers
+from .cache import make_key
+from . import export, mail
+from .models import Promo, Answer, Outbox, ExportJob
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_SCHEDULED_KEY = make_key('outbox', 'scheduled')
+
+
+def schedule_outbox_delivery():
+    """
+    Make sure a deliver_outbox run is due within OPPS_PROMOS_EMAIL_WINDOW
+    seconds, so entries queued meanwhile share its batches.
+    """
+    if not getattr(settings, "OPPS_PROMO_CELERY_ENABLED", True):
+        try:
+            mail.deliver_outbox()
+        except Exception:
+            logger.exception(u"Failed to deliver the email outbox")
+        return
+
+    if cache.add(OUTBOX_SCHEDULED_KEY, True, mail.EMAIL_WINDOW + 60):
+        deliver_outbox.apply_async(countdown=mail.EMAIL_WINDOW)
+
+
+def queue_confirmation_emails(answers):
+    if mail.queue_confirmations(answers):
+        schedule_outbox_delivery()
 
 
 @celery.task
 def send_confirmation_email(subject, obj, user):
+    """
+    Former per answer email task, kept so messages queued before the
+    outbox was deployed still get their email: the answers of ``user``
+    to the promo ``obj`` are queued in the outbox. ``subject`` is
+    ignored, the outbox builds the message from the promo templates.
+    """
+    ids = list(Answer.objects.filter(promo=obj.pk, user=user.pk).values_list(
+        'pk', flat=True))
+    queued = Outbox.objects.enqueue_ids(ids, Outbox.KIND_CONFIRMATION)
+    if queued:
+        schedule_outbox_delivery()
+    return len(queued)
+
+
+@celery.task(max_retries=5)
+def deliver_outbox(limit=None):
+    """
+    Send pending outbox emails, backing off exponentially while the mail
+    server fails. Also meant to run from celery beat as a safety net.
+    """
+    # entries queued from now on schedule another run
+    cache.delete(OUTBOX_SCHEDULED_KEY)
+    try:
+        return mail.deliver_outbox(limit=limit)
+    except (smtplib.SMTPException, socket.error) as exc:
+        retries = deliver_outbox.request.retries
+        deliver_outbox.retry(exc=exc,
+                             countdown=mail.EMAIL_WINDOW * 2 ** retries)
+
+
+@celery.task
+def notify_winners(promo_id):
+    """
+    Queue the winner notifications of a promo and have them delivered.
+    """
+    promo = Promo.objects.get(pk=promo_id)
+    queued = mail.queue_winner_notifications(promo)
+    schedule_outbox_delivery()
+    return queued
+
+
+def start_export_job(job):
+    """
+    Run ``job`` through celery, or right away with
+    OPPS_PROMO_CELERY_ENABLED = False.
+    """
+    if not getattr(settings, "OPPS_PROMO_CELERY_ENABLED", True):
+        try:
+            export.run_export(job)
+        except Exception:
+            logger.exception(u"Failed to export answers")
+        return
+    run_export_job.delay(job.pk)
+
+
+@celery.task(max_retries=5)
+def run_export_job(job_id):
+    """
+    Export answers for an ExportJob. The job may be queued before the
+    transaction creating it commits, hence the retries.
+    """
+    try:
+        job = ExportJob.objects.get(pk=job_id)
+    except ExportJob.DoesNotExist as exc:
+        run_export_job.retry(exc=exc, countdown=2)
+    return export.run_export(job)
+
+
+def queue_status_update(eta, now=None):
+    """
+    Queue update_promo_status at ``eta``, once per boundary instant.
+    """
+    now = now or timezone.now()
+    timeout = int((eta - now).total_seconds()) + 60
+    key = make_key('status_eta', eta.isoformat())
+    if cache.add(key, True, timeout):
+        try:
+            update_promo_status.apply_async(eta=eta)
+        except Exception:
+            cache.delete(key)
+            raise
+
+
+def schedule_status_update(promo):
+    """
+    Make sure a status run is queued at the next boundary of a saved
+    promo, which may come before any run already queued.
+    """
+    if not getattr(settings, "OPPS_PROMO_CELERY_ENABLED", True):
+        return
+    next_change = promo.next_status_change()
+    if next_change is None:
+        return
+    try:
+        queue_status_update(next_change)
+    except Exception:
+        # celery beat runs it anyway, a broker outage must not fail saves
+        logger.exception(u"Failed to schedule the promo status update")
+
+
+@celery.task
+def update_promo_status():
+    """
+    Apply pending promo status transitions and queue another run at the
+    exact instant of the next one. Also meant to run from celery beat
+    every few minutes as a safety net.
+    """
+    now = timezone.now()
+    changed = Promo.objects.update_status(now)
+
+    next_change = Promo.objects.next_status_change(now)
+    if next_change:
+        queue_status_update(next_change, now)
+
+    return [promo.pk for promo in changed]
+
+
+@celery.task
+def flush_answer_buffer():
+    """
+    Write answers waiting in the write-behind buffer. Schedule it with
+    celery beat at OPPS_PROMOS_ANSWER_BUFFER_WINDOW when using the cache
+    backend, so quiet periods still get flushed.
+    """
+    if answer_buffer is None:
+        return 0
+    return len(answer_buffer.flush())
+
 
-    DEFAULT_TXT = _(
-        u"Thank you! "
-        u"You are now inscribed to {obj.title}"
-    ).format(obj=obj)
-
-    msg = EmailMultiAlternatives(
-        subject,
-        obj.confirmation_email_txt or DEFAULT_TXT,
-        obj.confirmation_email_address or settings.DEFAULT_FROM_EMAIL,
-        [user.email]
-    )
-    msg.attach_alternative(
-        obj.confirmation_email_html or DEFAULT_TXT,
-        'text/html'
-    )
+@celery.task(max_retries=5)
+def persist_answer(data):
+    """
+    Write an answer accepted by PromoDetail in asynchronous mode. ``data``
+    comes from buffer.serialize_answer; its receipt status is updated by
+    write_answers, which also makes redeliveries harmless.
+    """
     try:
-        return msg.send()
-    except:
-        return None
+        return [answer.receipt for answer in write_answers([data])]
+    except DatabaseError as exc:
+        persist_answer.retry(
+            exc=exc, countdown=2 ** persist_answer.request.retries)
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 from django import template
 from django.conf import settings
+from django.http import QueryDict
 
 from opps.promos.models import Promo
+from opps.promos.paginator import KeysetPaginator, InvalidCursor
 
 
 register = template.Library()
@@ -11,22 +13,54 @@ register = template.Library()
 @register.assignment_tag
 def get_promos_by(opened=True, exclude=False, **filters):
     """
-        Return a list of promos filtered by given args
+        Return a list of promos filtered by given args, with banner,
+        main_image and channel loaded. Results are cached until a promo
+        of the site changes, and every call of a page shares one query.
 
         Usage:
 
           {% get_promos_by opened=[True|False] exclude=[True|False]
              filter1=value filter2=value .. %}
     """
+    return Promo.objects.get_promos_by(settings.SITE_ID, opened=opened,
+                                       exclude=exclude, **filters)
 
-    qs = Promo.objects.all_opened()
 
-    if not opened:
-        qs = Promo.objects.all_closed()
+@register.assignment_tag(takes_context=True)
+def keyset_paginate(context, queryset, per_page=20, param='cursor'):
+    """
+        Return a page of answers using the cursor found in the request
+
+        Usage:
+
+          {% keyset_paginate answers per_page=20 param="cursor" as page %}
+          {% for answer in page %} .. {% endfor %}
+          {% show_more page param="cursor" %}
+    """
+    request = context.get('request')
+    cursor = request.GET.get(param) if request else None
 
-    qs = qs.filter(site=settings.SITE_ID)
+    paginator = KeysetPaginator(queryset, per_page)
+    try:
+        return paginator.page(cursor)
+    except InvalidCursor:
+        return paginator.page()
+
+
+@register.inclusion_tag('promos/keyset_more.html', takes_context=True)
+def show_more(context, page, param='cursor'):
+    """
+        Render "load more" / "newer" links for a keyset page
+    """
+    request = context.get('request')
+    params = request.GET.copy() if request else QueryDict('', mutable=True)
 
-    if exclude:
-        return qs.exclude(**filters)
+    def url(cursor):
+        if cursor is None:
+            return None
+        params[param] = cursor
+        return u'?{0}'.format(params.urlencode())
 
-    return qs.filter(**filters)
+    return {'page': page,
+            'next_url': url(page.next_cursor),
+            'previous_url': url(page.previous_cursor)}
@@ -4,8 +4,51 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import csv
+import gzip
+import json
+import threading
+from StringIO import StringIO
+from datetime import timedelta
 
-from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.http import HttpResponse
+from django.template import Context, TemplateDoesNotExist
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.unittest import skipUnless
+
+from opps.channels.models import Channel
+
+from .models import (Promo, Answer, Outbox, ExportJob, get_channel,
+                     export_storage, participation_cache_key)
+from .admin import AnswerResource
+from .buffer import AnswerBuffer, Flusher, MemoryBackend, accept_answer
+from .cache import ResponseCache, get_generation, get_promo_version
+from . import export
+from .export import (export_response, run_export, supported_formats,
+                     ExportTooLarge)
+from .forms import AnonyUserForm, FormRegistry
+from .mail import (queue_confirmations, outbox_stats, email_templates,
+                   build_confirmations, deliver_outbox as deliver,
+                   queue_winner_notifications, BUILDERS, EMAIL_MAX_ATTEMPTS)
+from .paginator import KeysetPaginator
+from .ratelimit import RateLimiter, get_client_ip, parse_limits
+from .signals import promo_status_changed, promo_opened, promo_closed
+from .tasks import persist_answer, deliver_outbox, send_confirmation_email
+from .utils import (get_validators, TemplateNameCache, participation_cookie,
+                    participation_cookie_name, has_participation_token)
+from .views import (PromoDetail, PromoStatus, ReceiptStatus,
+                    ChannelPromoList)
 
 
 class SimpleTest(TestCase):
@@ -14,3 +57,1097 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class PromoTestMixin(object):
+
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create(username=u'promos',
+                                        email=u'promos@oppsproject.org')
+        self.site = Site.objects.get_current()
+        self.channel = Channel.objects.create(
+            name=u'Promos', slug=u'promos', site=self.site, user=self.user,
+            published=True)
+
+    def create_promo(self, slug, **kwargs):
+        now = timezone.now()
+        kwargs.setdefault('title', slug)
+        kwargs.setdefault('published', True)
+        kwargs.setdefault('date_available', now - timedelta(days=1))
+        return Promo.objects.create(slug=slug, site=self.site,
+                                    user=self.user, channel=self.channel,
+                                    **kwargs)
+
+
+@skipUnless(connection.vendor == 'sqlite', "EXPLAIN QUERY PLAN is sqlite")
+class QueryPlanTest(PromoTestMixin, TransactionTestCase):
+    """
+    Loads a synthetic dataset and checks the hot promo/answer queries are
+    served by an index instead of a full table scan.
+
+    sqlite commits before ANALYZE and EXPLAIN, which a TestCase could not
+    roll back, and the dataset is loaded once for all the checks.
+    """
+
+    promos = 200
+    users = 500
+    answers = 50000
+
+    def setUp(self):
+        super(QueryPlanTest, self).setUp()
+        now = timezone.now()
+        User = get_user_model()
+
+        self.promo = self.create_promo(u'benchmark')
+        for i in range(self.promos):
+            self.create_promo(u'closed-{0}'.format(i),
+                              date_end=now - timedelta(hours=1))
+
+        User.objects.bulk_create([
+            User(username=u'entrant-{0}'.format(i)) for i in range(self.users)
+        ])
+        user_ids = list(User.objects.values_list('pk', flat=True))
+        promo_ids = list(Promo.objects.values_list('pk', flat=True))
+
+        Answer.objects.bulk_create([
+            Answer(promo_id=promo_ids[i % len(promo_ids)],
+                   user_id=user_ids[i % len(user_ids)],
+                   answer=u'answer {0}'.format(i),
+                   published=bool(i % 3),
+                   is_winner=not i % 97)
+            for i in range(self.answers)
+        ], batch_size=500)
+
+        connection.cursor().execute('ANALYZE')
+
+    def query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+
+    def assertUsesIndex(self, queryset, table):
+        plan = self.query_plan(queryset)
+        steps = [step for step in plan if table in step]
+        self.assertTrue(steps, plan)
+        for step in steps:
+            self.assertIn('INDEX', step, plan)
+        self.assertFalse(
+            [step for step in plan if 'TEMP B-TREE' in step], plan)
+
+    def test_hot_queries_use_indexes(self):
+        self.assertUsesIndex(self.promo.answers, 'promos_answer')
+        self.assertUsesIndex(self.promo.winners, 'promos_answer')
+        # what exists() runs for Promo.has_answered
+        queryset = self.promo.answer_set.filter(user=self.user).order_by()
+        self.assertUsesIndex(queryset.values('pk')[:1], 'promos_answer')
+        self.assertUsesIndex(Promo.objects.all_opened(), 'promos_promo')
+
+
+class PromoDetailQueryTest(PromoTestMixin, TestCase):
+
+    def setUp(self):
+        super(PromoDetailQueryTest, self).setUp()
+        cache.clear()
+        Site.objects.clear_cache()
+        self.promo = self.create_promo(u'detail')
+
+    def get_view(self, slug):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        view = PromoDetail()
+        view.request = request
+        view.args = ()
+        view.kwargs = {'slug': slug}
+        return view
+
+    def get_object(self, slug):
+        promo = self.get_view(slug).get_object()
+        # everything the templates and get_template_names touch
+        promo.channel, promo.main_image, promo.banner, promo.site
+        return promo
+
+    def test_get_object_runs_one_query(self):
+        Site.objects.get_current()
+        with self.assertNumQueries(1):
+            promo = self.get_object(u'detail')
+        self.assertEqual(promo, self.promo)
+
+    @override_settings(OPPS_MULTISITE_FALLBACK=True)
+    def test_mirror_fallback_runs_one_query_when_warm(self):
+        mirror = Site.objects.create(domain=u'mirror.example.com',
+                                     name=u'mirror')
+        self.promo.mirror_site.add(mirror)
+
+        with self.settings(SITE_ID=mirror.pk):
+            self.assertEqual(self.get_object(u'detail'), self.promo)
+            with self.assertNumQueries(1):
+                promo = self.get_object(u'detail')
+        self.assertEqual(promo, self.promo)
+
+
+class ParticipationTest(PromoTestMixin, TestCase):
+
+    def setUp(self):
+        super(ParticipationTest, self).setUp()
+        cache.clear()
+        self.promo = self.create_promo(u'once')
+        self.key = participation_cache_key(self.promo.pk, self.user.pk)
+
+    def post(self, answer=u'mine'):
+        request = RequestFactory().post('/', {'answer': answer,
+                                              'agree': 'on'})
+        request.user = self.user
+        request.session = {}
+        return PromoDetail.as_view()(request, slug=self.promo.slug)
+
+    def test_double_submit_writes_one_answer(self):
+        response = self.post()
+        self.assertIn('success', response.context_data)
+
+        response = self.post(u'again')
+        self.assertEqual(unicode(response.context_data['error']),
+                         u"You already answered this promo")
+        self.assertEqual(self.promo.answer_set.count(), 1)
+
+    def test_concurrent_submit_hits_participation_key(self):
+        self.post()
+        # a second request that passed has_answered before the insert
+        cache.set(self.key, False)
+        response = self.post(u'again')
+        self.assertEqual(unicode(response.context_data['error']),
+                         u"You already answered this promo")
+        self.assertEqual(self.promo.answer_set.count(), 1)
+
+    def test_participation_cache(self):
+        answer = Answer.objects.create(promo=self.promo, user=self.user,
+                                       answer=u'mine')
+        self.assertTrue(cache.get(self.key))
+        with self.assertNumQueries(0):
+            self.assertTrue(self.promo.has_answered(self.user))
+
+        answer.delete()
+        self.assertEqual(cache.get(self.key), None)
+        self.assertFalse(self.promo.has_answered(self.user))
+
+
+class ParticipationCookieTest(PromoTestMixin, TestCase):
+
+    def setUp(self):
+        super(ParticipationCookieTest, self).setUp()
+        cache.clear()
+        self.promo = self.create_promo(u'anonymous', login_required=False)
+        self.other = self.create_promo(u'other', login_required=False)
+
+    def request(self, method='get', cookie=None, data=None):
+        request = getattr(RequestFactory(), method)('/', data or {})
+        request.user = AnonymousUser()
+        request.session = {}
+        if cookie:
+            request.COOKIES[cookie[0]] = cookie[1]
+        return request
+
+    def test_round_trip(self):
+        cookie = participation_cookie(self.promo)
+        self.assertEqual(cookie[0], participation_cookie_name(self.promo))
+        self.assertTrue(has_participation_token(
+            self.request(cookie=cookie), self.promo))
+        self.assertFalse(has_participation_token(self.request(), self.promo))
+
+    def test_tampered_token(self):
+        name, value, days = participation_cookie(self.promo)
+        tampered = (name, value[:-1] + ('a' if value[-1] != 'a' else 'b'))
+        self.assertFalse(has_participation_token(
+            self.request(cookie=tampered), self.promo))
+
+    def test_token_of_another_promo(self):
+        name, value, days = participation_cookie(self.other)
+        # the other promo's token under this promo's cookie name
+        cookie = (participation_cookie_name(self.promo), value)
+        self.assertFalse(has_participation_token(
+            self.request(cookie=cookie), self.promo))
+
+    def answer_queries(self, request):
+        """
+        Run PromoDetail on ``request``, returning the response and the
+        queries that touched the answer table.
+        """
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        del connection.queries[:]
+        try:
+            response = PromoDetail.as_view()(request, slug=self.promo.slug)
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+        return response, [query['sql'] for query in connection.queries
+                          if 'promos_answer' in query['sql']]
+
+    def test_answered_paths_skip_answer_queries(self):
+        cookie = participation_cookie(self.promo)
+
+        response, queries = self.answer_queries(self.request(cookie=cookie))
+        self.assertTrue(response.context_data['answered'])
+        self.assertEqual(queries, [])
+
+        response, queries = self.answer_queries(self.request(
+            'post', cookie, {'answer': u'mine', 'agree': 'on'}))
+        self.assertEqual(unicode(response.context_data['error']),
+                         u"You already answered this promo")
+        self.assertEqual(queries, [])
+        self.assertEqual(self.promo.answer_set.count(), 0)
+
+
+class KeysetPaginatorTest(PromoTestMixin, TestCase):
+
+    def setUp(self):
+        super(KeysetPaginatorTest, self).setUp()
+        self.promo = self.create_promo(u'keyset')
+        now = timezone.now()
+        # two answers share a date_insert to exercise the id tie breaker
+        dates = [now, now - timedelta(minutes=1), now - timedelta(minutes=1),
+                 now - timedelta(minutes=2), now - timedelta(minutes=3)]
+        for i, date in enumerate(dates):
+            answer = Answer.objects.create(promo=self.promo,
+                                           answer=u'answer {0}'.format(i))
+            Answer.objects.filter(pk=answer.pk).update(date_insert=date)
+        self.expected = list(Answer.objects.filter(
+            promo=self.promo).order_by('-date_insert', '-pk'))
+
+    def test_walk_forward_and_back(self):
+        paginator = KeysetPaginator(self.promo.answers, per_page=2)
+
+        pages, cursor = [], None
+        while True:
+            page = paginator.page(cursor)
+            pages.append(page)
+            if not page.has_next():
+                break
+            cursor = page.next_cursor
+
+        self.assertEqual([a for p in pages for a in p], self.expected)
+        self.assertFalse(pages[0].has_previous())
+
+        previous = paginator.page(pages[-1].previous_cursor)
+        self.assertEqual(list(previous), list(pages[-2]))
+
+    def test_no_count_query(self):
+        paginator = KeysetPaginator(self.promo.answers, per_page=2)
+        cursor = paginator.page().next_cursor
+        with self.assertNumQueries(1):
+            paginator.page(cursor)
+
+
+class AnswerDisplayTest(PromoTestMixin, TestCase):
+
+    def test_answers_for_display_joins_users(self):
+        promo = self.create_promo(u'display')
+        User = get_user_model()
+        for i in range(5):
+            user = User.objects.create(username=u'display-{0}'.format(i))
+            Answer.objects.create(promo=promo, user=user, answer=u'answer')
+
+        with self.assertNumQueries(1):
+            names = [answer.user.get_full_name()
+                     for answer in promo.answers_for_display]
+        self.assertEqual(len(names), 5)
+
+
+@override_settings(OPPS_PROMO_CELERY_ENABLED=False)
+class PromoStatusEngineTest(PromoTestMixin, TestCase):
+
+    def setUp(self):
+        super(PromoStatusEngineTest, self).setUp()
+        self.now = timezone.now()
+        self.promo = self.create_promo(
+            u'flash', date_available=self.now + timedelta(hours=1),
+            date_end=self.now + timedelta(hours=2))
+        self.received = []
+        for signal in (promo_status_changed, promo_opened, promo_closed):
+            signal.connect(self.receive, sender=Promo)
+            self.addCleanup(signal.disconnect, self.receive, sender=Promo)
+
+    def receive(self, signal, instance, **kwargs):
+        name = {promo_status_changed: 'changed', promo_opened: 'opened',
+                promo_closed: 'closed'}[signal]
+        self.received.append((name, instance.pk))
+
+    def status(self):
+        return Promo.objects.get(pk=self.promo.pk).status
+
+    def test_scheduled_open_closed(self):
+        self.assertEqual(self.status(), Promo.STATUS_SCHEDULED)
+        self.assertEqual(Promo.objects.next_status_change(self.now),
+                         self.promo.date_available)
+
+        opened_at = self.now + timedelta(minutes=90)
+        changed = Promo.objects.update_status(opened_at)
+        self.assertEqual([p.pk for p in changed], [self.promo.pk])
+        self.assertEqual(self.status(), Promo.STATUS_OPEN)
+        self.assertEqual(self.received, [('changed', self.promo.pk),
+                                         ('opened', self.promo.pk)])
+        self.assertEqual(Promo.objects.next_status_change(opened_at),
+                         self.promo.date_end)
+
+        # nothing left to do until the next boundary
+        self.assertEqual(Promo.objects.update_status(opened_at), [])
+
+        del self.received[:]
+        Promo.objects.update_status(self.now + timedelta(hours=3))
+        self.assertEqual(self.status(), Promo.STATUS_CLOSED)
+        self.assertEqual(self.received, [('changed', self.promo.pk),
+                                         ('closed', self.promo.pk)])
+        self.assertEqual(
+            Promo.objects.next_status_change(self.now + timedelta(hours=3)),
+            None)
+
+    def test_promo_ending_before_it_starts(self):
+        promo = self.create_promo(
+            u'inverted', date_available=self.now + timedelta(hours=1),
+            date_end=self.now - timedelta(hours=1))
+        self.assertEqual(promo.status, Promo.STATUS_SCHEDULED)
+        generation = get_generation(self.site.pk)
+
+        self.assertEqual(Promo.objects.update_status(self.now), [])
+        self.assertEqual(Promo.objects.update_status(self.now), [])
+        self.assertEqual(self.received, [])
+        self.assertEqual(get_generation(self.site.pk), generation)
+
+    def test_promo_next_status_change(self):
+        self.assertEqual(self.promo.next_status_change(self.now),
+                         self.promo.date_available)
+        self.assertEqual(
+            self.promo.next_status_change(self.now + timedelta(minutes=90)),
+            self.promo.date_end)
+        self.assertEqual(
+            self.promo.next_status_change(self.now + timedelta(hours=3)),
+            None)
+
+
+class AnswerCounterTest(PromoTestMixin, TestCase):
+
+    def setUp(self):
+        super(AnswerCounterTest, self).setUp()
+        self.promo = self.create_promo(u'counters')
+
+    def counters(self):
+        promo = Promo.objects.get(pk=self.promo.pk)
+        return (promo.answer_count, promo.published_answer_count,
+                promo.winner_count)
+
+    def test_answer_changes_update_counters(self):
+        answer = Answer.objects.create(promo=self.promo, answer=u'a',
+                                       published=False)
+        Answer.objects.create(promo=self.promo, answer=u'b', published=True)
+        self.assertEqual(self.counters(), (2, 1, 0))
+
+        answer.published = True
+        answer.is_winner = True
+        answer.save()
+        self.assertEqual(self.counters(), (2, 2, 1))
+
+        answer.delete()
+        self.assertEqual(self.counters(), (1, 1, 0))
+
+    def test_stale_promo_save_keeps_counters(self):
+        stale = Promo.objects.get(pk=self.promo.pk)
+        Answer.objects.create(promo=self.promo, answer=u'a', published=True)
+        stale.title = u'Renamed'
+        stale.save()
+        self.assertEqual(self.counters(), (1, 1, 0))
+        self.assertEqual(Promo.objects.get(pk=self.promo.pk).title,
+                         u'Renamed')
+
+    def test_recount_answers(self):
+        Answer.objects.create(promo=self.promo, answer=u'a', published=True,
+                              is_winner=True)
+        other = self.create_promo(u'untouched')
+        Promo.objects.filter(pk=self.promo.pk).update(
+            answer_count=7, published_answer_count=0, winner_count=3)
+
+        self.assertEqual(Promo.objects.recount_answers(), 1)
+        self.assertEqual(self.counters(), (1, 1, 1))
+        self.assertEqual(Promo.objects.recount_answers([other.pk]), 0)
+
+    def test_recount_command(self):
+        Answer.objects.create(promo=self.promo, answer=u'a', published=False)
+        Promo.objects.filter(pk=self.promo.pk).update(answer_count=0)
+        out = StringIO()
+        call_command('recount_promo_answers', str(self.promo.pk), stdout=out)
+        self.assertIn(u'1 promo(s) updated', out.getvalue())
+        self.assertEqual(self.counters(), (1, 0, 0))
+
+
+class FormRegistryTest(TestCase):
+
+    def setUp(self):
+        self.registry = FormRegistry()
+
+    def test_classes_are_built_once(self):
+        form = self.registry.get_answer_form(u'text')
+        self.assertIs(self.registry.get_answer_form(u'text'), form)
+        formset = self.registry.get_formset(AnonyUserForm)
+        self.assertIs(self.registry.get_formset(AnonyUserForm), formset)
+        self.assertEqual(self.registry.stats(),
+                         {'hits': 2, 'misses': 2, 'size': 2})
+
+        self.registry.get_answer_form(u'url')
+        self.assertEqual(self.registry.stats(),
+                         {'hits': 2, 'misses': 3, 'size': 3})
+
+    def test_fields_of_each_form_type(self):
+        expected = {
+            'none': set(),
+            'text': set(['answer']),
+            'upload': set(['answer_file']),
+            'url': set(['answer_url']),
+            'text|upload': set(['answer', 'answer_file']),
+            'text|url': set(['answer', 'answer_url']),
+            'text|url|upload': set(['answer', 'answer_url', 'answer_file']),
+        }
+        self.assertEqual(set(expected),
+                         set(name for name, label in Promo.FORM_TYPES))
+        for form_type, fields in expected.items():
+            form = self.registry.get_answer_form(form_type)
+            self.assertEqual(set(form.base_fields) - set(['agree']), fields,
+                             form_type)
+            for name in fields:
+                self.assertTrue(form().fields[name].required, name)
+
+
+class AnswerBufferTest(PromoTestMixin, TestCase):
+
+    def setUp(self):
+        super(AnswerBufferTest, self).setUp()
+        cache.clear()
+        self.promo = self.create_promo(u'flash')
+        self.buffer = AnswerBuffer(MemoryBackend(), batch_size=10, window=60)
+
+    def test_flush_writes_batches_and_counts(self):
+        for i in range(25):
+            self.buffer.append(Answer(promo=self.promo,
+                                      answer=u'answer {0}'.format(i)))
+        # two full batches were flushed inline, five are pending
+        self.assertEqual(len(self.buffer), 5)
+        self.buffer.flush()
+
+        self.assertEqual(Answer.objects.filter(promo=self.promo).count(), 25)
+        self.assertEqual(Promo.objects.get(pk=self.promo.pk).answer_count, 25)
+
+    def test_flush_drops_duplicates(self):
+        answer = Answer(promo=self.promo, user=self.user, answer=u'answer')
+        self.buffer.append(answer)
+        # replayed entry and a second submit of the same user
+        self.buffer.backend.append(self.buffer.backend.peek(1)[1][0])
+        self.buffer.append(Answer(promo=self.promo, user=self.user,
+                                  answer=u'again'))
+        self.buffer.flush()
+
+        self.assertEqual(
+            list(Answer.objects.filter(promo=self.promo).values_list(
+                'receipt', flat=True)), [answer.receipt])
+        self.assertTrue(self.promo.has_answered(self.user))
+
+    def test_flush_keeps_accept_time(self):
+        self.buffer.append(Answer(promo=self.promo, answer=u'late'))
+        accepted = self.buffer.backend.peek(1)[1][0]['date_insert']
+        self.buffer.flush()
+        self.assertEqual(Answer.objects.get(promo=self.promo).date_insert,
+                         accepted)
+
+    def test_background_flusher_honours_window(self):
+        flushed = threading.Event()
+        answer_buffer = AnswerBuffer(MemoryBackend(), window=0.05)
+        answer_buffer.backend.append({})
+        answer_buffer.flush = flushed.set
+        flusher = Flusher(answer_buffer)
+        flusher.start()
+        self.addCleanup(flusher.stop)
+        # no further append comes to trigger it
+        self.assertTrue(flushed.wait(5))
+
+
+class AsyncAnswerTest(PromoTestMixin, TestCase):
+    """
+    Runs persist_answer through celery's apply(), which executes the task
+    eagerly in process instead of going through a broker.
+    """
+
+    def setUp(self):
+        super(AsyncAnswerTest, self).setUp()
+        cache.clear()
+        self.promo = self.create_promo(u'async')
+
+    def receipt_status(self, receipt):
+        response = ReceiptStatus.as_view()(RequestFactory().get('/'),
+                                           receipt=receipt)
+        return json.loads(response.content)['status']
+
+    def test_receipt_is_persisted_once(self):
+        data = accept_answer(Answer(promo=self.promo, user=self.user,
+                                    answer=u'answer'))
+        self.assertEqual(self.receipt_status(data['receipt']), 'pending')
+
+        self.assertTrue(persist_answer.apply(args=(data,)).successful())
+        self.assertEqual(self.receipt_status(data['receipt']), 'persisted')
+
+        # a redelivered message does not write a second row
+        persist_answer.apply(args=(data,))
+        self.assertEqual(Answer.objects.filter(promo=self.promo).count(), 1)
+
+    def test_second_participation_is_rejected(self):
+        first = accept_answer(Answer(promo=self.promo, user=self.user,
+                                     answer=u'first'))
+        second = accept_answer(Answer(promo=self.promo, user=self.user,
+                                      answer=u'second'))
+        persist_answer.apply(args=(first,))
+        persist_answer.apply(args=(second,))
+
+        self.assertEqual(self.receipt_status(second['receipt']), 'rejected')
+
+
+class RateLimiterTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.limiter = RateLimiter()
+
+    def request(self, ip):
+        request = RequestFactory().post('/', REMOTE_ADDR=ip)
+        request.session = {}
+        return request
+
+    def test_bucket_per_ip(self):
+        limits = {'ip': '3/h', 'user': None, 'promo': '5/h'}
+        self.limiter.get_limits = lambda slug, promo_id: limits
+
+        allowed = [self.limiter.allow(self.request('10.0.0.1'), 'flash')
+                   for i in range(5)]
+        self.assertEqual(allowed, [True] * 3 + [False] * 2)
+
+        # other clients share what is left of the promo bucket
+        allowed = [self.limiter.allow(self.request('10.0.0.2'), 'flash')
+                   for i in range(3)]
+        self.assertEqual(allowed, [True, True, False])
+        self.assertEqual(self.limiter.get_rejections('flash'), 3)
+
+    def test_off_by_default(self):
+        allowed = [self.limiter.allow(self.request('10.0.0.1'), 'flash')
+                   for i in range(50)]
+        self.assertTrue(all(allowed))
+
+    def test_client_ip_from_proxy_end(self):
+        request = RequestFactory().post(
+            '/', HTTP_X_FORWARDED_FOR='6.6.6.6, 1.2.3.4, 10.0.0.9')
+        header = 'HTTP_X_FORWARDED_FOR'
+        self.assertEqual(get_client_ip(request, header, 1), '10.0.0.9')
+        self.assertEqual(get_client_ip(request, header, 2), '1.2.3.4')
+        self.assertEqual(get_client_ip(request, header, 5), '6.6.6.6')
+
+    def test_parse_limits(self):
+        self.assertEqual(parse_limits(u'ip=2/m promo=none'),
+                         {'ip': '2/m', 'promo': None})
+        self.assertRaises(ValueError, parse_limits, u'ip=2/week')
+        self.assertRaises(ValueError, parse_limits, u'referer=2/m')
+
+
+class PromoRateLimitTest(PromoTestMixin, TestCase):
+
+    def setUp(self):
+        super(PromoRateLimitTest, self).setUp()
+        cache.clear()
+        self.limiter = RateLimiter()
+        self.request = RequestFactory().post('/', REMOTE_ADDR='10.0.0.1')
+        self.request.session = {}
+
+    def test_limits_set_on_promo(self):
+        self.create_promo(u'limited', rate_limits=u'ip=2/h')
+        self.assertEqual([self.limiter.allow(self.request, u'limited')
+                          for i in range(3)], [True, True, False])
+        self.assertTrue(all(self.limiter.allow(self.request, u'unlimited')
+                            for i in range(3)))
+
+    def test_same_slug_on_other_site(self):
+        self.create_promo(u'shared', rate_limits=u'promo=1/h')
+        other = Site.objects.create(domain=u'other.example.com',
+                                    name=u'Other')
+        Promo.objects.create(slug=u'shared', title=u'shared', site=other,
+                             user=self.user, channel=self.channel,
+                             published=True, rate_limits=u'promo=2/h',
+                             date_available=timezone.now())
+        self.assertEqual([self.limiter.allow(self.request, u'shared')
+                          for i in range(2)], [True, False])
+        self.assertEqual([self.limiter.allow(self.request, u'shared', other)
+                          for i in range(3)], [True, True, False])
+
+
+class ResponseCacheTest(PromoTestMixin, TestCase):
+
+    def setUp(self):
+        super(ResponseCacheTest, self).setUp()
+        cache.clear()
+        self.response_cache = ResponseCache(timeout=60, stale=30)
+        self.request = RequestFactory().get('/promo.html')
+        self.key = self.response_cache.get_key(self.request, self.site.pk)
+        self.rendered = []
+
+    def render(self):
+        self.rendered.append(True)
+        return HttpResponse(u'render {0}'.format(len(self.rendered)))
+
+    def get(self, version):
+        return self.response_cache.get_response(
+            self.request, self.key, version, self.render).content
+
+    def test_cached_until_version_changes(self):
+        self.assertEqual(self.get(1), 'render 1')
+        self.assertEqual(self.get(1), 'render 1')
+        self.assertEqual(self.get(2), 'render 2')
+
+    def test_stale_served_while_revalidating(self):
+        self.get(1)
+        # another request holds the lock while rendering version 2
+        cache.add(u'{0}:lock'.format(self.key), True)
+        self.assertEqual(self.get(2), 'render 1')
+        self.assertEqual(len(self.rendered), 1)
+
+    def test_published_answers_bump_promo_version(self):
+        promo = self.create_promo(u'versioned')
+        version = get_promo_version(promo.pk)
+        answer = Answer.objects.create(promo=promo, answer=u'answer',
+                                       published=False)
+        self.assertEqual(get_promo_version(promo.pk), version)
+
+        answer.published = True
+        answer.save()
+        self.assertNotEqual(get_promo_version(promo.pk), version)
+
+
+class ConditionalGetTest(PromoTestMixin, TestCase):
+
+    def setUp(self):
+        super(ConditionalGetTest, self).setUp()
+        cache.clear()
+        self.promo = self.create_promo(u'conditional')
+
+    def get(self, **headers):
+        request = RequestFactory().get(self.promo.get_absolute_url(),
+                                       **headers)
+        request.user = AnonymousUser()
+        return PromoDetail.as_view()(request, slug=self.promo.slug)
+
+    def validators(self):
+        return get_validators(u'{0}.{1}'.format(
+            get_generation(self.site.pk), get_promo_version(self.promo.pk)))
+
+    def test_not_modified_without_rendering(self):
+        etag, last_modified = self.validators()
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_new_answer_changes_etag(self):
+        etag, last_modified = self.validators()
+        Answer.objects.create(promo=self.promo, answer=u'answer')
+        self.assertNotEqual(self.validators()[0], etag)
+
+
+class TemplateNameCacheTest(TestCase):
+
+    def test_resolved_name_is_remembered(self):
+        names = ['promos/missing/keyset.html', 'promos/keyset_more.html']
+        template_cache = TemplateNameCache(enabled=True)
+        self.assertEqual(template_cache.resolve('key', names),
+                         ['promos/keyset_more.html'])
+        # the chain is not probed again
+        self.assertEqual(template_cache.resolve('key', []),
+                         ['promos/keyset_more.html'])
+
+    def test_missing_chain_is_remembered(self):
+        template_cache = TemplateNameCache(enabled=True)
+        names = ['promos/missing.html']
+        self.assertRaises(TemplateDoesNotExist,
+                          template_cache.resolve, 'key', names)
+        self.assertIn('key', template_cache._resolved)
+
+
+class VisibilityTest(PromoTestMixin, TestCase):
+
+    def setUp(self):
+        super(VisibilityTest, self).setUp()
+        cache.clear()
+        self.mirror = Site.objects.create(domain=u'mirror.example.com',
+                                          name=u'mirror')
+
+    def test_visible_ids_include_mirrored_promos(self):
+        own = self.create_promo(u'own')
+        mirrored = self.create_promo(u'mirrored')
+        mirrored.mirror_site.add(self.site, self.mirror)
+        closed = self.create_promo(
+            u'closed', date_end=timezone.now() - timedelta(hours=1))
+        closed.mirror_site.add(self.mirror)
+
+        visible = Promo.objects.get_visible_ids(self.site)
+        self.assertEqual(visible['opened'], sorted([own.pk, mirrored.pk]))
+        self.assertEqual(Promo.objects.get_visible_ids(self.mirror),
+                         {'opened': [mirrored.pk], 'closed': [closed.pk]})
+
+        with self.assertNumQueries(0):
+            Promo.objects.get_visible_ids(self.mirror)
+
+    def test_opened_and_closed_ids_are_cached(self):
+        opened = self.create_promo(u'opened')
+        closed = self.create_promo(
+            u'closed', date_end=timezone.now() - timedelta(hours=1))
+        self.assertEqual(Promo.objects.opened_ids(self.site), [opened.pk])
+        with self.assertNumQueries(0):
+            self.assertEqual(Promo.objects.opened_ids(self.site), [opened.pk])
+            self.assertEqual(Promo.objects.closed_ids(self.site), [closed.pk])
+        self.assertEqual(list(Promo.objects.all_opened(self.site)), [opened])
+        self.assertEqual(list(Promo.objects.all_closed(self.site)), [closed])
+
+    def test_channel_lookup_is_cached(self):
+        self.assertEqual(get_channel(u'promos', self.site), self.channel)
+        self.assertIsNone(get_channel(u'missing', self.site))
+        with self.assertNumQueries(0):
+            self.assertEqual(get_channel(u'promos', self.site), self.channel)
+            self.assertIsNone(get_channel(u'missing', self.site))
+
+        self.channel.save()
+        with self.assertNumQueries(1):
+            get_channel(u'promos', self.site)
+
+    def test_channel_list_binds_no_id_list(self):
+        own = self.create_promo(u'own')
+        mirrored = self.create_promo(u'mirrored')
+        mirrored.mirror_site.add(self.mirror)
+        closed = [self.create_promo(
+            u'closed-{0}'.format(i),
+            date_end=timezone.now() - timedelta(hours=1)) for i in range(20)]
+        self.create_promo(u'draft', published=False)
+
+        view = ChannelPromoList()
+        view.request = RequestFactory().get('/channel/promos')
+        view.kwargs = {'channel__long_slug': u'promos'}
+        queryset = view.queryset
+        self.assertEqual(set(queryset), set([own, mirrored] + closed))
+        # a fixed number of parameters, not one per promo
+        self.assertLess(len(queryset.query.sql_with_params()[1]),
+                        len(closed))
+
+        with self.settings(SITE_ID=self.mirror.pk):
+            self.assertEqual(list(view.queryset), [mirrored])
+
+
+class PromosByTest(PromoTestMixin, TestCase):
+
+    def setUp(self):
+        super(PromosByTest, self).setUp()
+        cache.clear()
+        self.first = self.create_promo(u'first', order=1)
+        self.second = self.create_promo(u'second', order=2)
+
+    def test_filter_sets_share_one_query(self):
+        Promo.objects.opened_ids(self.site)
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                Promo.objects.get_promos_by(self.site, slug=u'first'),
+                [self.first])
+            self.assertEqual(
+                Promo.objects.get_promos_by(self.site, exclude=True,
+                                            slug=u'first'),
+                [self.second])
+            self.assertEqual(
+                Promo.objects.get_promos_by(
+                    self.site, channel__long_slug=u'promos', order__gte=2),
+                [self.second])
+
+    def test_unsupported_lookup_uses_the_database(self):
+        promos = Promo.objects.get_promos_by(self.site,
+                                             mirror_site__isnull=True)
+        self.assertEqual(promos, [self.first, self.second])
+
+    def test_promo_save_invalidates(self):
+        self.assertEqual(
+            Promo.objects.get_promos_by(self.site, slug=u'second'),
+            [self.second])
+        self.second.slug = u'renamed'
+        self.second.save()
+        self.assertEqual(
+            Promo.objects.get_promos_by(self.site, slug=u'second'), [])
+
+    def test_incomparable_values_use_the_database(self):
+        # a naive string against aware datetimes, as templates pass them
+        promos = Promo.objects.get_promos_by(
+            self.site, date_available__gte=u'2000-01-01')
+        self.assertEqual(promos, [self.first, self.second])
+
+    def test_channel_save_invalidates(self):
+        promos = Promo.objects.get_promos_by(self.site, slug=u'first')
+        self.assertEqual(promos[0].channel.name, u'Promos')
+        self.channel.name = u'Renamed'
+        self.channel.save()
+        promos = Promo.objects.get_promos_by(self.site, slug=u'first')
+        self.assertEqual(promos[0].channel.name, u'Renamed')
+
+
+@override_settings(OPPS_PROMO_CELERY_ENABLED=False)
+class PromoStatusTest(PromoTestMixin, TestCase):
+
+    def setUp(self):
+        super(PromoStatusTest, self).setUp()
+        cache.clear()
+        self.opened = self.create_promo(u'opened')
+        self.closed = self.create_promo(
+            u'closed', date_end=timezone.now() - timedelta(hours=1),
+            display_winners=True)
+        self.scheduled = self.create_promo(
+            u'scheduled', date_available=timezone.now() + timedelta(days=1))
+        Answer.objects.create(promo=self.closed, answer=u'answer',
+                              is_winner=True)
+
+    def get(self, query):
+        request = RequestFactory().get('/status.json?' + query)
+        return json.loads(PromoStatus.as_view()(request).content)['promos']
+
+    def test_many_slugs_in_one_call(self):
+        promos = self.get('slug=opened,closed&slug=missing')
+        self.assertEqual(sorted(promos), [u'closed', u'opened'])
+        self.assertEqual(promos['opened']['status'], Promo.STATUS_OPEN)
+        self.assertFalse(promos['opened']['winners_published'])
+        self.assertEqual(promos['closed']['participants'], 1)
+        self.assertTrue(promos['closed']['winners_published'])
+
+    def test_scheduled_promo_counts_down(self):
+        promos = self.get('slug=scheduled')
+        self.assertEqual(promos['scheduled']['status'],
+                         Promo.STATUS_SCHEDULED)
+        self.assertEqual(promos['scheduled']['opens_at'],
+                         self.scheduled.date_available.isoformat())
+
+    def test_served_from_cache(self):
+        self.get('slug=opened,closed,scheduled')
+        with self.assertNumQueries(0):
+            self.get('slug=opened,closed,scheduled')
+
+
+@override_settings(
+    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class ConfirmationEmailTest(PromoTestMixin, TestCase):
+
+    def setUp(self):
+        super(ConfirmationEmailTest, self).setUp()
+        cache.clear()
+        self.promo = self.create_promo(u'confirmed', login_required=False,
+                                       send_confirmation_email=True)
+
+    def test_batch_is_sent_over_one_connection(self):
+        answers = [
+            Answer.objects.create(promo=self.promo, user=self.user,
+                                  answer=u'registered'),
+            Answer.objects.create(
+                promo=self.promo, answer=u'anonymous',
+                user_anony_data={'name': u'Anonymous',
+                                 'email': u'anonymous@oppsproject.org'}),
+            Answer.objects.create(promo=self.create_promo(u'silent'),
+                                  user=self.user, answer=u'silent'),
+        ]
+        self.assertEqual(len(queue_confirmations(answers)), 2)
+
+        self.assertEqual(deliver_outbox.apply().result, 2)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         [u'anonymous@oppsproject.org',
+                          u'promos@oppsproject.org'])
+        self.assertEqual(outbox_stats()['sent'], 2)
+
+    @override_settings(OPPS_PROMO_CELERY_ENABLED=False)
+    def test_legacy_task_goes_through_outbox(self):
+        Answer.objects.create(promo=self.promo, user=self.user,
+                              answer=u'answer')
+        result = send_confirmation_email.apply(
+            args=(u'Subject', self.promo, self.user)).result
+        self.assertEqual(result, 1)
+        self.assertEqual([m.to[0] for m in mail.outbox],
+                         [u'promos@oppsproject.org'])
+
+    def test_each_answer_is_delivered_once(self):
+        answer = Answer.objects.create(promo=self.promo, user=self.user,
+                                       answer=u'answer')
+        queue_confirmations([answer])
+        # a second queueing of the same answer is dropped
+        self.assertEqual(queue_confirmations([answer]), [])
+
+        deliver_outbox.apply()
+        deliver_outbox.apply()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(
+            Outbox.objects.get(answer=answer).status, Outbox.STATUS_SENT)
+
+    def test_build_errors_count_as_attempts(self):
+        def broken(promo, answers):
+            raise ValueError(u"Broken template")
+        kind = Outbox.KIND_CONFIRMATION
+        self.addCleanup(BUILDERS.__setitem__, kind, BUILDERS[kind])
+        BUILDERS[kind] = broken
+
+        answer = Answer.objects.create(promo=self.promo, user=self.user,
+                                       answer=u'answer')
+        queue_confirmations([answer])
+        for i in range(EMAIL_MAX_ATTEMPTS + 1):
+            # past the retry delay
+            Outbox.objects.update(date_claimed=None)
+            self.assertEqual(deliver(), 0)
+
+        entry = Outbox.objects.get(answer=answer)
+        self.assertEqual(entry.status, Outbox.STATUS_FAILED)
+        self.assertEqual(entry.attempts, EMAIL_MAX_ATTEMPTS)
+        self.assertIn(u'Broken template', entry.error)
+
+    @override_settings(OPPS_PROMO_CELERY_ENABLED=False)
+    def test_buffered_answers_are_resolved_by_receipt(self):
+        answer = Answer(promo=self.promo, user=self.user, answer=u'buffered')
+        persist_answer.apply(args=(accept_answer(answer),))
+
+        self.assertEqual([m.to for m in mail.outbox],
+                         [[u'promos@oppsproject.org']])
+
+
+class EmailTemplateTest(PromoTestMixin, TestCase):
+
+    def setUp(self):
+        super(EmailTemplateTest, self).setUp()
+        email_templates.clear()
+        self.promo = self.create_promo(
+            u'templated', login_required=False,
+            confirmation_email_txt=u'Hi {{ name }}, you sent '
+                                   u'"{{ answer_summary }}" to {{ promo.title }}')
+
+    def test_compiled_once_and_rendered_per_recipient(self):
+        answers = [
+            Answer.objects.create(
+                promo=self.promo, answer=u'answer {0}'.format(i),
+                user_anony_data={'name': u'Entrant {0}'.format(i),
+                                 'email': u'{0}@oppsproject.org'.format(i)})
+            for i in range(3)]
+
+        messages = build_confirmations(self.promo, answers)
+        build_confirmations(self.promo, answers)
+        self.assertEqual(email_templates.misses, 1)
+        self.assertEqual(messages[answers[1].pk].body,
+                         u'Hi Entrant 1, you sent "answer 1" to templated')
+
+    def test_promo_update_recompiles(self):
+        email_templates.get(self.promo, 'confirmation_email_txt')
+        self.promo.confirmation_email_txt = u'Bye {{ name }}'
+        self.promo.save()
+        template = email_templates.get(self.promo, 'confirmation_email_txt')
+        self.assertEqual(email_templates.misses, 2)
+        self.assertIn('Bye', template.render(Context({})))
+
+
+@override_settings(
+    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class WinnerNotificationTest(PromoTestMixin, TestCase):
+
+    def setUp(self):
+        super(WinnerNotificationTest, self).setUp()
+        self.promo = self.create_promo(u'winners', login_required=False)
+        for i in range(5):
+            Answer.objects.create(
+                promo=self.promo, answer=u'answer {0}'.format(i),
+                is_winner=i % 2 == 0,
+                user_anony_data={'name': u'Winner {0}'.format(i),
+                                 'email': u'{0}@oppsproject.org'.format(i)})
+
+    def test_interrupted_run_resumes(self):
+        self.assertEqual(queue_winner_notifications(self.promo, 2), 3)
+        # stopped after the first email
+        deliver(limit=1)
+        self.assertEqual(len(mail.outbox), 1)
+
+        call_command('notify_winners', self.promo.slug, stdout=StringIO())
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         [u'0@oppsproject.org', u'2@oppsproject.org',
+                          u'4@oppsproject.org'])
+        self.assertIn(u'Winner 2', mail.outbox[1].body)
+
+        # nothing is sent twice
+        call_command('notify_winners', self.promo.slug, stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 3)
+
+
+class AnswerExportTest(PromoTestMixin, TestCase):
+
+    def setUp(self):
+        super(AnswerExportTest, self).setUp()
+        self.promo = self.create_promo(u'export', login_required=False)
+        for i in range(5):
+            Answer.objects.create(promo=self.promo, user=self.user,
+                                  answer=u'resposta {0}'.format(i),
+                                  is_winner=i == 0)
+
+    def test_streams_csv_in_chunks(self):
+        # three chunks of two rows, promo and user joined in each
+        with self.assertNumQueries(3):
+            response = export_response(AnswerResource(),
+                                       Answer.objects.all(), 'csv',
+                                       chunk_size=2)
+            content = ''.join(response.streaming_content)
+        rows = list(csv.reader(StringIO(content)))
+        self.assertEqual(len(rows), 6)
+        self.assertIn('resposta 0', rows[1])
+        self.assertIn(u'Sim'.encode('utf-8'), rows[1])
+        self.assertIn(u'N\xe3o'.encode('utf-8'), rows[2])
+        self.assertIn('promos@oppsproject.org', rows[5])
+
+    @skipUnless('xlsx' in supported_formats(), "XLSX needs openpyxl")
+    def test_large_xlsx_is_refused(self):
+        self.addCleanup(setattr, export, 'EXPORT_XLSX_MAX_ROWS',
+                        export.EXPORT_XLSX_MAX_ROWS)
+        export.EXPORT_XLSX_MAX_ROWS = 4
+        with self.assertRaises(ExportTooLarge):
+            export_response(AnswerResource(), Answer.objects.all(), 'xlsx')
+
+        export.EXPORT_XLSX_MAX_ROWS = 5
+        response = export_response(AnswerResource(), Answer.objects.all(),
+                                   'xlsx')
+        self.assertTrue(''.join(response.streaming_content))
+
+    def test_export_job_concatenates_shards(self):
+        other = self.create_promo(u'other', login_required=False)
+        Answer.objects.create(promo=other, answer=u'outra')
+        job = ExportJob.objects.create(promo=self.promo)
+
+        # shards of two ids, exported in this process
+        name = run_export(job, processes=1, range_size=2)
+        self.addCleanup(export_storage.delete, name)
+        self.assertRegexpMatches(name, r'^promos/exports/[0-9a-f]{32}/')
+        job = ExportJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, ExportJob.STATUS_DONE)
+        self.assertEqual(job.ranges, 3)
+        self.assertEqual(job.progress, 100)
+
+        rows = list(csv.reader(gzip.GzipFile(
+            fileobj=export_storage.open(job.file.name))))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual([row for row in rows if 'outra' in row], [])
+
+    def test_export_download_needs_staff(self):
+        job = ExportJob.objects.create(promo=self.promo)
+        name = run_export(job, processes=1)
+        self.addCleanup(export_storage.delete, name)
+        url = reverse('admin:promos_exportjob_download', args=[job.pk])
+
+        # anonymous users get the admin login form, not the file
+        response = self.client.get(url)
+        self.assertFalse(response.has_header('Content-Disposition'))
+
+        User = get_user_model()
+        admin = User.objects.create_superuser(
+            u'exporter', u'exporter@oppsproject.org', u'secret')
+        self.client.login(username=admin.username, password=u'secret')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        content = gzip.GzipFile(
+            fileobj=StringIO(''.join(response.streaming_content))).read()
+        self.assertIn('resposta 4', content)
@@ -3,7 +3,8 @@
 #
 from django.conf.urls import patterns, url
 
-from .views import PromoDetail, PromoList, ChannelPromoList
+from .views import (PromoDetail, PromoList, ChannelPromoList, ReceiptStatus,
+                    PromoStatus)
 
 
 urlpatterns = patterns(
@@ -18,6 +19,16 @@ urlpatterns = patterns(
         ChannelPromoList.as_view(),
         name='channel_promo'
     ),
+    url(
+        r'^status\.json$',
+        PromoStatus.as_view(),
+        name='promo_status'
+    ),
+    url(
+        r'^receipt/(?P<receipt>[0-9a-f]{32})\.json$',
+        ReceiptStatus.as_view(),
+        name='receipt_status'
+    ),
     url(
         r'^(?P<slug>[\w-]+)/(?P<result>[\w-]+)$',
         PromoDetail.as_view(),
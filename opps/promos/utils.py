@@ -1,7 +1,26 @@
 # coding: utf-8
 
 import datetime
+import threading
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.template import TemplateDoesNotExist
+from django.template.loader import find_template
 from django.template.response import TemplateResponse
+from django.utils.http import (http_date, parse_etags, parse_http_date_safe,
+                               quote_etag)
+
+PARTICIPATION_COOKIE_DAYS = getattr(
+    settings, 'OPPS_PROMOS_PARTICIPATION_COOKIE_DAYS', 90)
+
+PARTICIPATION_COOKIE_PREFIX = 'opps_promo_'
+
+TEMPLATE_NAME_CACHE = getattr(settings, 'OPPS_PROMOS_TEMPLATE_NAME_CACHE',
+                              not settings.TEMPLATE_DEBUG)
+
+participation_signer = signing.Signer(salt='opps.promos.participation')
 
 
 def set_cookie(response, key, value, days_expire=90):
@@ -32,3 +51,100 @@ class CookedResponse(TemplateResponse):
 
         if cookie:
             set_cookie(self, *cookie)
+
+
+def participation_cookie_name(promo):
+    return '{0}{1}'.format(PARTICIPATION_COOKIE_PREFIX, promo.pk)
+
+
+def participation_cookie(promo):
+    """
+    Return the (key, value, days) cookie marking an anonymous entrant as
+    having answered ``promo``, suitable for ``CookedResponse``.
+    """
+    token = participation_signer.sign(
+        u'{0}:{1}'.format(promo.pk, uuid.uuid4().hex))
+    return (participation_cookie_name(promo), token,
+            PARTICIPATION_COOKIE_DAYS)
+
+
+def has_participation_token(request, promo):
+    value = request.COOKIES.get(participation_cookie_name(promo))
+    if not value:
+        return False
+    try:
+        promo_id = participation_signer.unsign(value).split(u':', 1)[0]
+    except signing.BadSignature:
+        return False
+    return promo_id == unicode(promo.pk)
+
+
+def get_validators(version):
+    """
+    Return the ``(etag, last_modified)`` of a page from its content
+    version, made of millisecond timestamps joined by dots.
+    """
+    stamps = [int(part) for part in unicode(version).split(u'.')]
+    return quote_etag(unicode(version)), max(stamps) // 1000
+
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def is_not_modified(request, etag, last_modified):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        return if_none_match == '*' or \
+            etag in [quote_etag(e) for e in parse_etags(if_none_match)]
+    since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE'))
+    return since is not None and last_modified <= since
+
+
+class TemplateNameCache(object):
+    """
+    Remember which name of a candidate chain exists, so the loaders are
+    not probed for the missing ones on every request. Kept per process,
+    so a deploy starts afresh; disabled with TEMPLATE_DEBUG, where
+    templates are edited in place.
+    """
+
+    def __init__(self, enabled=TEMPLATE_NAME_CACHE):
+        self.enabled = enabled
+        self._resolved = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, key, names):
+        """
+        Return a list holding the first of ``names`` that exists, raising
+        TemplateDoesNotExist when none does.
+        """
+        if not self.enabled:
+            return names
+
+        try:
+            name = self._resolved[key]
+        except KeyError:
+            name = None
+            for candidate in names:
+                try:
+                    find_template(candidate)
+                except TemplateDoesNotExist:
+                    continue
+                name = candidate
+                break
+            with self._lock:
+                self._resolved[key] = name
+
+        if name is None:
+            raise TemplateDoesNotExist(u', '.join(names))
+        return [name]
+
+    def clear(self):
+        with self._lock:
+            self._resolved.clear()
+
+
+template_name_cache = TemplateNameCache()
@@ -1,23 +1,42 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import json
 from importlib import import_module
 
 from django.conf import settings
-from django.http import Http404
+from django.core.urlresolvers import reverse
+from django.http import Http404, HttpResponse, HttpResponseNotModified
+from django.views.generic.base import View
 from django.views.generic.detail import DetailView
 from django.views.generic.list import ListView
-from django.shortcuts import get_object_or_404
 from django.contrib.auth.views import redirect_to_login
+from django.core.cache import cache
 from django.utils import timezone
+from django.utils.cache import patch_cache_control
 from django.utils.translation import ugettext_lazy as _
-from django.contrib.sites.models import get_current_site, Site
+from django.contrib.sites.models import get_current_site
+from django.db import IntegrityError, transaction
 from django.db.models import Q
-from django.forms.formsets import formset_factory
 
-from opps.channels.models import Channel
-
-from .models import Promo, Answer
-from .tasks import send_confirmation_email
+from .models import Promo, Answer, app_namespace, get_channel
+from .cache import (make_key, response_cache, get_generation,
+                    get_promo_version)
+from .forms import form_registry
+from .ratelimit import rate_limiter
+from .buffer import (answer_buffer, accept_answer, get_receipt_status,
+                     RECEIPT_PENDING)
+from .mail import queue_confirmations
+from .tasks import schedule_outbox_delivery, persist_answer
+from .utils import (CookedResponse, participation_cookie,
+                    has_participation_token, PARTICIPATION_COOKIE_PREFIX,
+                    get_validators, set_validators, is_not_modified,
+                    template_name_cache)
+
+ASYNC_ANSWERS = getattr(settings, 'OPPS_PROMOS_ASYNC_ANSWERS', False)
+CONDITIONAL_GET = getattr(settings, 'OPPS_PROMOS_CONDITIONAL_GET', True)
+STATUS_CACHE_TIMEOUT = getattr(settings, 'OPPS_PROMOS_STATUS_CACHE_TIMEOUT',
+                               10)
+STATUS_MAX_SLUGS = 50
 
 if not 'endless_pagination' in settings.INSTALLED_APPS:
     settings.INSTALLED_APPS += (
@@ -25,7 +44,64 @@ if not 'endless_pagination' in settings.INSTALLED_APPS:
     )
 
 
-class PromoList(ListView):
+class AnonymousCacheMixin(object):
+    """
+    Answer conditional anonymous GETs from the page content version and,
+    when ``OPPS_PROMOS_RESPONSE_CACHE_TIMEOUT`` is set, serve them from the
+    response cache. Only the ``cache_params`` query parameters are allowed,
+    anything else renders uncached.
+    """
+
+    cache_params = ('page',)
+
+    def get_cache_version(self, site):
+        """
+        Return the content version of the page, or None to not cache it.
+        """
+        return get_generation(site.pk)
+
+    def is_cacheable(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            return False
+        if request.user.is_authenticated():
+            return False
+        # entrants see their own answered state
+        if [name for name in request.COOKIES
+                if name.startswith(PARTICIPATION_COOKIE_PREFIX)]:
+            return False
+        return set(request.GET).issubset(self.cache_params)
+
+    def dispatch(self, request, *args, **kwargs):
+        render = lambda: super(AnonymousCacheMixin, self).dispatch(
+            request, *args, **kwargs)
+        if not (CONDITIONAL_GET or response_cache.timeout) or \
+                not self.is_cacheable(request):
+            return render()
+
+        site = get_current_site(request)
+        version = self.get_cache_version(site)
+        if version is None:
+            return render()
+
+        if CONDITIONAL_GET:
+            etag, last_modified = get_validators(version)
+            if is_not_modified(request, etag, last_modified):
+                return set_validators(HttpResponseNotModified(), etag,
+                                      last_modified)
+
+        if response_cache.timeout:
+            response = response_cache.get_response(
+                request, response_cache.get_key(request, site.pk), version,
+                render)
+        else:
+            response = render()
+
+        if CONDITIONAL_GET and response.status_code == 200:
+            set_validators(response, etag, last_modified)
+        return response
+
+
+class PromoList(AnonymousCacheMixin, ListView):
 
     context_object_name = "promos"
 
@@ -36,14 +112,11 @@ class PromoList(ListView):
     @property
     def queryset(self):
         site = get_current_site(self.request)
-        promos = Promo.objects.all_opened()
-        long_slug = self.request.path.strip('/')
-        self.channel = get_object_or_404(
-            Channel, site=site.id, long_slug=long_slug)
-        return promos.filter(
-            Q(mirror_site__domain=site.domain) |
-            Q(site=site.id)
-        ).distinct()
+        self.channel = get_channel(self.request.path.strip('/'), site)
+        if self.channel is None:
+            raise Http404(u"Channel does not exist")
+        return Promo.objects.filter(
+            pk__in=Promo.objects.get_visible_ids(site)['opened'])
 
     def get_context_data(self, *args, **kwargs):
         context = super(PromoList, self).get_context_data(*args, **kwargs)
@@ -51,7 +124,7 @@ class PromoList(ListView):
         return context
 
 
-class ChannelPromoList(ListView):
+class ChannelPromoList(AnonymousCacheMixin, ListView):
 
     context_object_name = "promos"
 
@@ -64,20 +137,31 @@ class ChannelPromoList(ListView):
         long_slug = self.kwargs.get('channel__long_slug')
         return 'promos/{0}.html'.format(long_slug)
 
+    def get_template_names(self):
+        names = super(ChannelPromoList, self).get_template_names()
+        return template_name_cache.resolve(
+            ('channel', self.kwargs.get('channel__long_slug')), names)
+
     @property
     def queryset(self):
         site = get_current_site(self.request)
         long_slug = self.kwargs['channel__long_slug'].strip('/')
-        self.channel = get_object_or_404(Channel, long_slug=long_slug)
-
-        return Promo.objects.filter(
-            channel__long_slug=long_slug,
+        self.channel = get_channel(long_slug)
+        if self.channel is None:
+            raise Http404(u"Channel does not exist")
+
+        # closed promos pile up over the years: the mirrored ones go in a
+        # subquery rather than a bound parameter per id, and an IN over
+        # it needs no DISTINCT
+        visible = Promo.objects.filter(
+            channel=self.channel,
             published=True,
-            date_available__lte=timezone.now()
-        ).filter(
-            Q(mirror_site__domain=site.domain) |
-            Q(site__domain=site.domain)
-        ).distinct()
+            status__in=(Promo.STATUS_OPEN, Promo.STATUS_CLOSED)
+        )
+        return visible.filter(
+            Q(site=site.pk) |
+            Q(pk__in=visible.filter(mirror_site=site.pk).values('pk'))
+        )
 
     def get_context_data(self, *args, **kwargs):
         context = super(ChannelPromoList, self).get_context_data(*args,
@@ -86,10 +170,19 @@ class ChannelPromoList(ListView):
         return context
 
 
-class PromoDetail(DetailView):
+class PromoDetail(AnonymousCacheMixin, DetailView):
 
     context_object_name = "promo"
     model = Promo
+    response_class = CookedResponse
+    cache_params = ('page', 'cursor', 'winners_cursor')
+
+    def get_cache_version(self, site):
+        pk = Promo.objects.get_visible_id(self.kwargs['slug'], site)
+        if not pk:
+            return None
+        return u'{0}.{1}'.format(get_generation(site.pk),
+                                 get_promo_version(pk))
 
     def get_template_names(self):
         """
@@ -108,6 +201,7 @@ class PromoDetail(DetailView):
             app_label = self.model._meta.app_label
             object_name = self.model._meta.object_name.lower()
 
+        long_slug = None
         if self.object.channel:
             long_slug = self.object.channel.long_slug
             # 1. try channel/promo template
@@ -142,25 +236,41 @@ class PromoDetail(DetailView):
                 self.template_name_suffix
             ))
 
-        return names
+        return template_name_cache.resolve(
+            ('detail', app_label, long_slug, self.kwargs['slug'],
+             self.template_name_suffix), names)
+
+    def get_queryset(self):
+        return Promo.objects.select_related('channel', 'main_image',
+                                            'banner', 'site')
 
     def get_object(self):
         self.fallback = getattr(settings, 'OPPS_MULTISITE_FALLBACK', False)
         self.site = get_current_site(self.request)
-        self.site_master = Site.objects.order_by('id')[0]
 
-        filters = dict(slug=self.kwargs['slug'], site=self.site)
+        queryset = self.get_queryset()
+        filters = dict(slug=self.kwargs['slug'])
         preview_enabled = self.request.user and self.request.user.is_staff
         if not preview_enabled:
-            filters['date_available__lte'] = timezone.now()
+            filters['status__in'] = (Promo.STATUS_OPEN, Promo.STATUS_CLOSED)
             filters['published'] = True
 
+            if self.fallback:
+                # the cached map covers the site and its mirrors at once
+                pk = Promo.objects.get_visible_id(self.kwargs['slug'],
+                                                  self.site)
+                if pk:
+                    try:
+                        return queryset.get(pk=pk, **filters)
+                    except Promo.DoesNotExist:
+                        pass
+                raise Http404(u"Promo object does not exist")
+
         try:
-            return Promo.objects.get(**filters)
+            return queryset.get(site=self.site, **filters)
         except Promo.DoesNotExist:
             if self.fallback:
-                filters.pop('site', None)
-                promos = Promo.objects.filter(
+                promos = queryset.filter(
                     **filters
                 ).filter(
                     Q(mirror_site__domain=self.site.domain) |
@@ -174,19 +284,31 @@ class PromoDetail(DetailView):
 
         raise Http404(u"Promo object does not exist")
 
+    def receipt_response(self, receipt):
+        return HttpResponse(json.dumps({
+            'receipt': receipt,
+            'status': RECEIPT_PENDING,
+            'status_url': reverse('{0}:receipt_status'.format(app_namespace),
+                                  kwargs={'receipt': receipt})
+        }), content_type='application/json', status=202)
+
     def userformset_factory(self, cls):
-        return formset_factory(cls, max_num=1, extra=1, can_delete=False)
+        return form_registry.get_formset(cls)
 
     def get(self, request, *args, **kwargs):
         self.object = self.get_object()
 
         context = super(PromoDetail, self).get_context_data(**kwargs)
 
-        context['answers'] = self.object.answers
+        context['answers'] = self.object.answers_for_display
         context['request'] = self.request
-        context['winners'] = self.object.winners
+        context['winners'] = self.object.winners_for_display
 
-        context['answered'] = self.object.has_answered(request.user)
+        if request.user.is_authenticated():
+            context['answered'] = self.object.has_answered(request.user)
+        else:
+            context['answered'] = has_participation_token(request,
+                                                          self.object)
 
         AnswerForm = self.object.get_answer_form()
         form = AnswerForm()
@@ -205,10 +327,17 @@ class PromoDetail(DetailView):
         return self.render_to_response(context)
 
     def post(self, request, *args, **kwargs):
+        # before any form or database work, and without rendering
+        if not rate_limiter.allow(request, kwargs['slug'],
+                                  get_current_site(request)):
+            return HttpResponse(_(u"Too many requests, try again later"),
+                                content_type='text/plain', status=429)
+
         self.object = self.get_object()
 
         context = self.get_context_data(**kwargs)
-        context['answers'] = self.object.answers
+        context['answers'] = self.object.answers_for_display
+        context['winners'] = self.object.winners_for_display
         context['request'] = request
         if self.object.channel:
             context['channel'] = self.object.channel
@@ -224,6 +353,12 @@ class PromoDetail(DetailView):
             context['error'] = _(u"You already answered this promo")
             return self.render_to_response(context)
 
+        # anonymous entrants carry a signed cookie once they answered
+        if not request.user.is_authenticated() and \
+                has_participation_token(request, self.object):
+            context['error'] = _(u"You already answered this promo")
+            return self.render_to_response(context)
+
         AnswerForm = self.object.get_answer_form()
 
         form = AnswerForm(request.POST, request.FILES)
@@ -237,6 +372,7 @@ class PromoDetail(DetailView):
             is_valid.append(user_formset.is_valid())
             context['user_formset'] = user_formset
 
+        response_kwargs = {}
         if all(is_valid):
             instance = form.save(commit=False)
 
@@ -251,21 +387,110 @@ class PromoDetail(DetailView):
                 instance.user_anony_data = user_anony_data
 
             instance.promo = self.object
-            instance.save()
+
+            if ASYNC_ANSWERS:
+                # stores the upload now, the row is written by a worker
+                data = accept_answer(instance)
+                persist_answer.delay(data)
+                context['receipt'] = data['receipt']
+                if request.is_ajax():
+                    return self.receipt_response(data['receipt'])
+            elif answer_buffer is not None:
+                # duplicates are dropped when the buffer is flushed
+                context['receipt'] = answer_buffer.append(instance)
+            else:
+                # the participation key makes a concurrent double submit fail
+                sid = transaction.savepoint()
+                try:
+                    instance.save()
+                except IntegrityError:
+                    transaction.savepoint_rollback(sid)
+                    context['error'] = _(u"You already answered this promo")
+                    return self.render_to_response(context)
+                # written along with the answer
+                queued = queue_confirmations([instance])
+                transaction.savepoint_commit(sid)
+                if queued:
+                    schedule_outbox_delivery()
             context['success'] = instance
+
+            if not request.user.is_authenticated():
+                response_kwargs['cookie'] = participation_cookie(self.object)
         else:
             context['form'] = form
             context['error'] = form.non_field_errors()
             return self.render_to_response(context)
 
         context['form'] = form
-        # send confirmation email
-        if self.object.send_confirmation_email:
-            subject = _(u"You are now registered for %s.") % self.object.title
-            if getattr(settings, "OPPS_PROMO_CELERY_ENABLED", True):
-                send_confirmation_email.delay(subject,
-                                              self.object, request.user)
-            else:
-                send_confirmation_email(subject, self.object, request.user)
 
-        return self.render_to_response(context)
+        return self.render_to_response(context, **response_kwargs)
+
+
+class ReceiptStatus(View):
+    """
+    Report whether an answer accepted asynchronously was written.
+    """
+
+    def get(self, request, receipt):
+        response = HttpResponse(json.dumps({
+            'receipt': receipt,
+            'status': get_receipt_status(receipt)
+        }), content_type='application/json')
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+
+class PromoStatus(View):
+    """
+    Status of many promos in one call, for widgets computing countdowns
+    client side::
+
+        GET status.json?slug=promo-a&slug=promo-b
+
+    Scheduled promos are listed too, with the opens_at to count down to.
+    """
+
+    def promo_status(self, promo):
+        return {
+            'status': promo['status'],
+            'opens_at': promo['date_available'] and
+            promo['date_available'].isoformat(),
+            'closes_at': promo['date_end'] and promo['date_end'].isoformat(),
+            'participants': promo['answer_count'],
+            'winners_published': bool(promo['display_winners'] and
+                                      promo['winner_count']),
+        }
+
+    def get(self, request):
+        site = get_current_site(request)
+        slugs = []
+        for value in request.GET.getlist('slug'):
+            for slug in value.split(','):
+                if slug and slug not in slugs:
+                    slugs.append(slug)
+        slugs = slugs[:STATUS_MAX_SLUGS]
+
+        ids = dict((slug, Promo.objects.get_visible_id(slug, site,
+                                                       scheduled=True))
+                   for slug in slugs)
+        keys = dict((pk, make_key('status', pk)) for pk in ids.values() if pk)
+        found = cache.get_many(keys.values())
+
+        missing = [pk for pk, key in keys.items() if key not in found]
+        if missing:
+            fetched = dict(
+                (keys[promo['pk']], self.promo_status(promo))
+                for promo in Promo.objects.filter(pk__in=missing).values(
+                    'pk', 'status', 'date_available', 'date_end',
+                    'answer_count', 'display_winners', 'winner_count'))
+            cache.set_many(fetched, STATUS_CACHE_TIMEOUT)
+            found.update(fetched)
+
+        promos = dict((slug, found[keys[pk]]) for slug, pk in ids.items()
+                      if pk and keys[pk] in found)
+        response = HttpResponse(json.dumps({
+            'now': timezone.now().isoformat(),
+            'promos': promos,
+        }), content_type='application/json')
+        patch_cache_control(response, max_age=STATUS_CACHE_TIMEOUT)
+        return response